@@ -0,0 +1,127 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Messages are stored as nested lists of {role, content} structs.
+MESSAGES_TYPE = pa.list_(pa.struct([("role", pa.string()), ("content", pa.string())]))
+
+QUALITY_SCHEMA = pa.schema([
+    ("uid", pa.string()),
+    ("session_model", pa.string()),
+    ("interview_model", pa.string()),
+    ("session", MESSAGES_TYPE),
+    ("interview", MESSAGES_TYPE),
+    ("session_start", pa.string()),
+    ("session_end", pa.string()),
+    ("interview_start", pa.string()),
+    ("interview_end", pa.string()),
+    ("quality", pa.string()),
+    ("source_file", pa.string()),
+])
+
+CHAT_LOGS_SCHEMA = pa.schema([
+    ("uid", pa.string()),
+    ("session_model", pa.string()),
+    ("session", MESSAGES_TYPE),
+    ("session_start", pa.string()),
+    ("session_end", pa.string()),
+    ("source_file", pa.string()),
+])
+
+INTERVIEW_LOGS_SCHEMA = pa.schema([
+    ("uid", pa.string()),
+    ("session_model", pa.string()),
+    ("interview_model", pa.string()),
+    ("interview", MESSAGES_TYPE),
+    ("interview_start", pa.string()),
+    ("interview_end", pa.string()),
+    ("source_file", pa.string()),
+])
+
+def message_text(content):
+    """
+    Returns the text of a message whose content is either a string or a list of text parts.
+    """
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return content or ""
+
+def normalize_messages(messages):
+    """
+    Convert messages to plain {role, content} dicts with string content.
+    """
+    return [{"role": message.get("role", ""), "content": message_text(message.get("content"))} for message in messages or []]
+
+class ParquetBatchWriter:
+    """
+    Writes rows (dicts) to a Parquet file in row groups of batch_size, so only one batch is held in memory.
+    Message columns are normalized to lists of {role, content}.
+    """
+    def __init__(self, path: str, schema: pa.Schema, batch_size: int = 1000):
+        self.schema = schema
+        self.batch_size = batch_size
+        self.message_columns = [field.name for field in schema if field.type == MESSAGES_TYPE]
+        self.rows = []
+        self.writer = pq.ParquetWriter(path, schema, compression="zstd")
+
+    def write(self, row: dict):
+        row = {name: row.get(name) for name in self.schema.names}
+        for name in self.message_columns:
+            row[name] = normalize_messages(row[name])
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def read_table(path: str, columns: list = None):
+    """
+    Read a Parquet output into a pandas DataFrame, loading only the requested columns.
+    For example: read_table("data/conversation_quality.parquet", ["uid", "session_model", "quality"]).
+    """
+    return pq.read_table(path, columns=columns).to_pandas()
+
+def iter_parquet_records(path: str, columns: list = None, batch_size: int = 1000, start: int = 0):
+    """
+    Yield the rows of a Parquet file as dicts, one record batch at a time.
+    Rows before start are skipped; row groups that lie entirely before it are not read at all.
+    """
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    first_group, skipped = 0, 0
+    while first_group < metadata.num_row_groups and skipped + metadata.row_group(first_group).num_rows <= start:
+        skipped += metadata.row_group(first_group).num_rows
+        first_group += 1
+    if first_group == metadata.num_row_groups:
+        return
+    skip = start - skipped
+    for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=range(first_group, metadata.num_row_groups), columns=columns):
+        if skip >= batch.num_rows:
+            skip -= batch.num_rows
+            continue
+        yield from batch.slice(skip).to_pylist()
+        skip = 0
+
+def parquet_num_rows(path: str) -> int:
+    """
+    Number of rows of a Parquet file, read from its footer.
+    """
+    return pq.ParquetFile(path).metadata.num_rows
+
+def read_parquet_row(path: str, index: int) -> dict:
+    """
+    One row of a Parquet file, reading only the row group that holds it.
+    """
+    parquet_file = pq.ParquetFile(path)
+    for group in range(parquet_file.metadata.num_row_groups):
+        rows = parquet_file.metadata.row_group(group).num_rows
+        if index < rows:
+            return parquet_file.read_row_group(group).slice(index, 1).to_pylist()[0]
+        index -= rows
+    raise IndexError("Parquet row index out of range")
@@ -1,11 +1,18 @@
 import json
+import re
+from collections import Counter
 from emoji import emoji_count
 import csv
-from openai import OpenAI
 import uuid
+import hashlib
+import threading
 import os
 from dotenv import load_dotenv
 
+from get_data import iter_records
+from llm_client import RateLimiter, estimate_tokens, ordered_map, chat_completion, get_client
+from columnar import ParquetBatchWriter, CHAT_LOGS_SCHEMA, INTERVIEW_LOGS_SCHEMA, QUALITY_SCHEMA, message_text
+
 allowed_models = set([
   "us.anthropic.claude-3-5-sonnet-20241022-v2:0",
   "gpt-4o",
@@ -66,23 +73,118 @@ keyphrases = [
     "#", "**",
   ]
 
-mother_prompt = """
+quality_criteria = """
 If any of the following criteria is observed in the input session or interview, this data point is of low quality:
 1. If the user used a chatbot to complete the chatbot
 2. If the user used a chatbot to complete the interview
 3. If the user's responses to the chatbot did not make logical sense (e.g., did not understand the task, responded randomly, etc.)
 4. If the user's responses to the interview did not make logical sense (e.g., did not understand the task, responded randomly, etc.)
+"""
 
+mother_prompt = quality_criteria + """
 Predict if the following data point is low quality or not and no need to tell me why.
 # First in a new line predict if the passage is of low quality of high quality. Just say “low quality” or “high quality”, nothing else in this line.
 """
 
-def is_high_quality(client, model, session, interview):
+# Used when several records are judged in one request.
+batch_prompt = quality_criteria + """
+Each data point below is numbered. Predict for every data point if it is low quality or not and no need to tell me why.
+# Respond with a single JSON object mapping each data point number to "low quality" or "high quality", e.g. {"1": "high quality", "2": "low quality"}, and nothing else.
+"""
+
+# All keyphrases compiled into one alternation (longest first), so each message is scanned in a single pass.
+keyphrase_pattern = re.compile("|".join(re.escape(phrase) for phrase in sorted(set(keyphrases), key=len, reverse=True)))
+
+# Heuristic rejection rules, in the order they are checked.
+PREFILTER_RULES = ["short_session", "short_interview", "long_message", "keyphrase", "emoji"]
+
+def prefilter_record(session, interview):
+    """
+    Applies the cheap chatbot-detection heuristics to a record.
+    Returns the name of the first rule that rejects it, or None if the record should go to the LLM judge.
+    """
+    if not session or len(session) <= 1:
+        return "short_session"
+    if not interview or len(interview) <= 2:
+        return "short_interview"
+    for message in session:
+        if message['role'] != 'user':
+            continue
+        content = message_text(message["content"])
+        if len(content) >= 1500:
+            return "long_message"
+        if keyphrase_pattern.search(content):
+            return "keyphrase"
+        if emoji_count(content):
+            return "emoji"
+    return None
+
+def prefilter_records(records, rejection_counts: Counter):
+    """
+    Runs the heuristic prefilter over a stream of records, yielding (record, rejected_by) pairs
+    and counting rejections per rule.
+    """
+    for record in records:
+        rejected_by = prefilter_record(record.get("session", []), record.get("interview", []))
+        if rejected_by:
+            rejection_counts[rejected_by] += 1
+        yield record, rejected_by
+
+def is_high_quality(client, model, session, interview, rate_limiter: RateLimiter = None):
     """
     Uses an LLM to determine if an interview is high-quality.
+    Records rejected by the heuristic prefilter never reach the LLM.
+    """
+    # Chatbot Detection
+    if prefilter_record(session, interview):
+        return False
+    return judge_quality(client, model, session, interview, rate_limiter)
+
+# Assistant turns are never cut below this many tokens, so the judge always sees how each answer starts.
+MIN_ASSISTANT_TURN_TOKENS = 32
+
+def assistant_turn_cap(lengths: list, budget: int):
+    """
+    Returns the largest per-turn token cap such that the capped assistant turns fit in the budget,
+    or None if every turn fits uncut.
+    """
+    remaining = budget
+    for index, length in enumerate(sorted(lengths)):
+        share = remaining // (len(lengths) - index)
+        if length > share:
+            return max(share, MIN_ASSISTANT_TURN_TOKENS)
+        remaining -= length
+    return None
+
+def truncate_turn(text: str, max_tokens: int):
+    """
+    Keeps the start of a long turn and replaces the rest with an elision marker.
     """
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return text[:max_tokens * 4] + f" [... {tokens - max_tokens} tokens elided ...]"
 
-    passage = """
+def build_passage(session, interview, token_budget: int = None):
+    """
+    Serializes a record into the passage shown to the quality judge.
+    With a token budget, user turns are kept verbatim and long assistant turns are truncated
+    with an elision marker so that the passage fits the budget where possible.
+    """
+    if token_budget is not None:
+        assistant_lengths = [estimate_tokens(message_text(message.get("content"))) for message in session + interview if message.get("role") != "user"]
+        user_tokens = sum(estimate_tokens(message_text(message.get("content"))) for message in session + interview if message.get("role") == "user")
+        cap = assistant_turn_cap(assistant_lengths, token_budget - user_tokens)
+        if cap is not None:
+            session, interview = [
+                [
+                    message if message.get("role") == "user" else dict(message, content=truncate_turn(message_text(message.get("content")), cap))
+                    for message in messages
+                ]
+                for messages in (session, interview)
+            ]
+
+    return """
     session:
     {}
 
@@ -90,55 +192,230 @@ def is_high_quality(client, model, session, interview):
     {}
     """.format(json.dumps(session), json.dumps(interview))
 
-    # Chatbot Detection
-    if not session or len(session) <= 1:
-        return False
-    if not interview or len(interview) <= 2:
-        return False
-    for message in session:
-        if message['role'] == 'user' and (len(message["content"]) >= 1500 or any(phrase in message['content'] for phrase in keyphrases) or emoji_count(message["content"])):
-            return False
+def judge_quality(client, model, session, interview, rate_limiter: RateLimiter = None):
+    """
+    Asks the LLM judge whether a record that passed the prefilter is high-quality.
+    If a rate limiter is given, the request waits for its share of the request and token budget.
+    """
+    return judge_passage(client, model, build_passage(session, interview), rate_limiter)
 
+def judge_passage(client, model, passage: str, rate_limiter: RateLimiter = None):
+    """
+    Asks the LLM judge whether a single serialized record is high-quality.
+    """
     prompt = mother_prompt + passage
 
-    response = client.chat.completions.create(
-        model=model, 
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-    )
-
-    classification = response.choices[0].message.content.strip()
+    classification = chat_completion(client, model, [{"role": "user", "content": prompt}], rate_limiter)
     return "high quality" in classification
 
-def process_logs(client, model, input_file: str, chat_logs_file: str, interview_logs_file: str, csv_output_file: str):
+def parse_batch_verdicts(response_content: str, count: int):
     """
-    Filters conversations, creates chat and interview logs, and outputs a CSV with quality classification.
+    Parses a batched verdict object such as {"1": "high quality", "2": "low quality"}.
+    Returns one boolean per data point, or None if the response is malformed or incomplete.
     """
+    start, end = response_content.find("{"), response_content.rfind("}")
+    if start == -1 or end < start:
+        return None
     try:
-        with open(input_file, 'r') as file:
-            data = json.load(file)
+        verdicts = json.loads(response_content[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(verdicts, dict):
+        return None
+
+    results = []
+    for index in range(1, count + 1):
+        verdict = str(verdicts.get(str(index), "")).lower()
+        if "high quality" in verdict:
+            results.append(True)
+        elif "low quality" in verdict:
+            results.append(False)
+        else:
+            return None
+    return results
+
+def judge_quality_batch(client, model, passages: list, rate_limiter: RateLimiter = None):
+    """
+    Judges several serialized records in one request.
+    Returns one boolean per passage and the estimated prompt tokens sent.
+    Falls back to one request per record if the batched response cannot be parsed.
+    """
+    if len(passages) == 1:
+        return [judge_passage(client, model, passages[0], rate_limiter)], estimate_tokens(mother_prompt + passages[0])
+
+    prompt = batch_prompt + "".join(f"\nData point {index}:{passage}" for index, passage in enumerate(passages, start=1))
+    prompt_tokens = estimate_tokens(prompt)
+    response_content = chat_completion(client, model, [{"role": "user", "content": prompt}], rate_limiter)
+    results = parse_batch_verdicts(response_content, len(passages))
+    if results is None:
+        print(f"Could not parse batched verdicts for {len(passages)} records; judging them one at a time.")
+        results = [judge_passage(client, model, passage, rate_limiter) for passage in passages]
+        prompt_tokens += sum(estimate_tokens(mother_prompt + passage) for passage in passages)
+    return results, prompt_tokens
+
+def pack_judge_batches(items, verdicts: dict, batch_size: int, token_budget: int, passage_token_budget: int = None):
+    """
+    Groups prefiltered (record, rejected_by) items into batches of at most batch_size records to judge,
+    whose passages together stay within token_budget. Yields lists of (record, uid, rejected_by, passage);
+    passage is None for records that are rejected or already journaled, which cost nothing to carry along.
+    Each passage is built within passage_token_budget, if given.
+    """
+    batch = []
+    pending = 0
+    batch_tokens = 0
+    for record, rejected_by in items:
+        uid = record_uid(record)
+        passage = None
+        if not rejected_by and uid not in verdicts:
+            passage = build_passage(record.get("session", []), record.get("interview", []), passage_token_budget)
+            tokens = estimate_tokens(passage)
+            if pending and (pending >= batch_size or batch_tokens + tokens > token_budget):
+                yield batch
+                batch, pending, batch_tokens = [], 0, 0
+            pending += 1
+            batch_tokens += tokens
+        batch.append((record, uid, rejected_by, passage))
+    if batch:
+        yield batch
 
-        chat_logs = []
-        interview_logs = []
-        csv_rows = []
+# Namespace for record uids, so that the same source log always maps to the same uid.
+UID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "clue-insighter/record")
 
-        for record in data:
-            session = record.get("session", [])
+def record_uid(record):
+    """
+    Derives a deterministic uid from the source file name, the session start and a digest of the record content.
+    """
+    content = json.dumps({"session": record.get("session", []), "interview": record.get("interview", [])}, sort_keys=True)
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(UID_NAMESPACE, "|".join([str(record.get("sourceFile") or ""), str(record.get("sessionStart") or ""), digest])))
+
+CSV_FIELDS = ["uid", "session_model", "interview_model", "session", "interview", "session_start", "session_end", "interview_start", "interview_end", "quality", "source_file"]
+
+def load_journal(journal_file: str):
+    """
+    Load the verdicts recorded so far: { uid: {"uid", "quality", "rejected_by"} }.
+    A partially written last line (e.g. after a crash) is ignored.
+    """
+    verdicts = {}
+    if not os.path.exists(journal_file):
+        return verdicts
+    with open(journal_file, 'r') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            verdicts[entry["uid"]] = entry
+    return verdicts
+
+def iter_existing_logs(logs_file: str, replaced_sources: set):
+    """
+    Yield previously written chat or interview logs, dropping records whose source file is being re-ingested.
+    """
+    if not os.path.exists(logs_file):
+        return
+    for log in iter_records(logs_file):
+        if log.get("source_file") not in replaced_sources:
+            yield log
+
+def iter_existing_csv_rows(csv_file: str, replaced_sources: set):
+    """
+    Yield previously written quality CSV rows, dropping rows whose source file is being re-ingested.
+    """
+    if not os.path.exists(csv_file):
+        return
+    csv.field_size_limit(2**31 - 1)
+    with open(csv_file, 'r', newline='') as file:
+        for row in csv.DictReader(file):
+            if row.get("source_file") not in replaced_sources:
+                yield [row.get(field, "") for field in CSV_FIELDS]
+
+class JsonArrayWriter:
+    """
+    Writes a JSON array one item at a time, so the full list never has to be held in memory.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+        self.file.write("[\n")
+
+    def write(self, item):
+        if self.count:
+            self.file.write(",\n")
+        self.file.write(json.dumps(item, indent=4))
+        self.count += 1
+
+    def close(self):
+        self.file.write("\n]\n")
+
+def parquet_path(path: str):
+    """
+    Returns the Parquet counterpart of a JSON or CSV output path.
+    """
+    return os.path.splitext(path)[0] + ".parquet"
+
+def materialize_outputs(input_file: str, verdicts: dict, chat_logs_file: str, interview_logs_file: str, csv_output_file: str, append: bool, replaced_sources: set,
+                        write_parquet: bool = False):
+    """
+    Write the chat logs, interview logs and quality CSV from the input records and their journaled verdicts.
+    If write_parquet is set, the same three tables are also written as Parquet files with messages as nested lists.
+    Each output is written to a temporary file and moved into place once complete.
+    """
+    outputs = [chat_logs_file, interview_logs_file, csv_output_file]
+    if write_parquet:
+        outputs += [parquet_path(path) for path in outputs]
+
+    with open(chat_logs_file + ".tmp", 'w') as chat_file, \
+         open(interview_logs_file + ".tmp", 'w') as interview_file, \
+         open(csv_output_file + ".tmp", 'w', newline='') as csv_file:
+        chat_logs = JsonArrayWriter(chat_file)
+        interview_logs = JsonArrayWriter(interview_file)
+        writer = csv.writer(csv_file)
+        writer.writerow(CSV_FIELDS)
+
+        chat_sinks = [chat_logs]
+        interview_sinks = [interview_logs]
+        quality_sinks = []
+        if write_parquet:
+            chat_sinks.append(ParquetBatchWriter(parquet_path(chat_logs_file) + ".tmp", CHAT_LOGS_SCHEMA))
+            interview_sinks.append(ParquetBatchWriter(parquet_path(interview_logs_file) + ".tmp", INTERVIEW_LOGS_SCHEMA))
+            quality_sinks.append(ParquetBatchWriter(parquet_path(csv_output_file) + ".tmp", QUALITY_SCHEMA))
+
+        def write_quality_row(row):
+            writer.writerow([json.dumps(row[field]) if isinstance(row[field], list) else row[field] for field in CSV_FIELDS])
+            for sink in quality_sinks:
+                sink.write(row)
+
+        if append:
+            for chat_log in iter_existing_logs(chat_logs_file, replaced_sources):
+                for sink in chat_sinks:
+                    sink.write(chat_log)
+            for interview_log in iter_existing_logs(interview_logs_file, replaced_sources):
+                for sink in interview_sinks:
+                    sink.write(interview_log)
+            for values in iter_existing_csv_rows(csv_output_file, replaced_sources):
+                row = dict(zip(CSV_FIELDS, values))
+                row["session"] = json.loads(row["session"] or "[]")
+                row["interview"] = json.loads(row["interview"] or "[]")
+                write_quality_row(row)
+
+        for record in iter_records(input_file):
+            source_file = record.get("sourceFile", "")
             interview = record.get("interview", [])
-            
-            quality = "high-quality" if is_high_quality(client, model, session, interview) else "low-quality"
-            
-            uid = str(uuid.uuid4())
+
+            uid = record_uid(record)
+            quality = verdicts[uid]["quality"]
             if quality == "high-quality":
                 chat_log = {
                     "uid": uid,
                     "session_model": record.get("sessionModel", ""),
                     "session": record.get("session", []),
                     "session_start": record.get("sessionStart", ""),
-                    "session_end": record.get("sessionEnd", "")
+                    "session_end": record.get("sessionEnd", ""),
+                    "source_file": source_file
                 }
-                chat_logs.append(chat_log)
+                for sink in chat_sinks:
+                    sink.write(chat_log)
 
                 interview_log = {
                     "uid": uid,
@@ -146,33 +423,125 @@ def process_logs(client, model, input_file: str, chat_logs_file: str, interview_
                     "interview_model": record.get("interviewModel", ""),
                     "interview": interview,
                     "interview_start": record.get("interviewStart", ""),
-                    "interview_end": record.get("interviewEnd", "")
+                    "interview_end": record.get("interviewEnd", ""),
+                    "source_file": source_file
                 }
-                interview_logs.append(interview_log)
-
-            csv_rows.append([
-                uid, record.get("session_model", ""),
-                record.get("interview_model", ""), json.dumps(record.get("session", [])), json.dumps(interview),
-                record.get("session_start", ""), record.get("session_end", ""),
-                record.get("interview_start", ""), record.get("interview_end", ""), quality
-            ])
-        
-        with open(chat_logs_file, 'w') as file:
-            json.dump(chat_logs, file, indent=4)
-        with open(interview_logs_file, 'w') as file:
-            json.dump(interview_logs, file, indent=4)
-        
-        with open(csv_output_file, 'w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(["uid", "session_model", "interview_model", "session", "interview", "session_start", "session_end", "interview_start", "interview_end", "quality"])
-            writer.writerows(csv_rows)
-        
+                for sink in interview_sinks:
+                    sink.write(interview_log)
+
+            write_quality_row({
+                "uid": uid,
+                "session_model": record.get("sessionModel", ""),
+                "interview_model": record.get("interviewModel", ""),
+                "session": record.get("session", []),
+                "interview": interview,
+                "session_start": record.get("sessionStart", ""),
+                "session_end": record.get("sessionEnd", ""),
+                "interview_start": record.get("interviewStart", ""),
+                "interview_end": record.get("interviewEnd", ""),
+                "quality": quality,
+                "source_file": source_file
+            })
+
+        for sink in chat_sinks + interview_sinks + quality_sinks:
+            sink.close()
+
+    for path in outputs:
+        os.replace(path + ".tmp", path)
+
+def process_logs(client, model, input_file: str, chat_logs_file: str, interview_logs_file: str, csv_output_file: str, append: bool = False,
+                 max_workers: int = 1, requests_per_minute: float = None, tokens_per_minute: float = None, journal_file: str = None,
+                 write_parquet: bool = False, batch_size: int = 1, batch_token_budget: int = 4000,
+                 passage_token_budget: int = None, removed_sources: set = None):
+    """
+    Filters conversations, creates chat and interview logs, and outputs a CSV with quality classification.
+    Records are streamed from input_file, which can be a JSON file or a folder of JSONL shards.
+    If append is set, input_file is treated as a delta batch and merged into the existing outputs;
+    records from a re-ingested (changed) log file replace the ones it produced before, and records from the
+    log files named in removed_sources (deleted since the last run) are dropped.
+    With max_workers > 1, quality judgements run concurrently within the requests/tokens-per-minute budget;
+    outputs keep the input order.
+    Every verdict is appended to a journal (quality_journal.jsonl next to the CSV by default) as soon as it
+    is made. A rerun skips records already in the journal, and the outputs are materialized from it.
+    If write_parquet is set, columnar .parquet copies of the three outputs are written alongside them.
+    With batch_size > 1, up to batch_size short records (within batch_token_budget estimated tokens) are judged per request.
+    passage_token_budget caps each record's passage by truncating long assistant turns; user turns are always kept.
+    Returns True once the outputs are written, or False if processing failed.
+    """
+    try:
+        if journal_file is None:
+            journal_file = os.path.join(os.path.dirname(csv_output_file), "quality_journal.jsonl")
+        verdicts = load_journal(journal_file)
+        journal_lock = threading.Lock()
+
+        # Without an explicit quota, requests share the client endpoint's limiter (see llm_client.configure_endpoint).
+        rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute) if requests_per_minute or tokens_per_minute else None
+        rejection_counts = Counter()
+        source_files = set()
+        resumed = 0
+        request_counts = Counter()
+
+        with open(journal_file, 'a') as journal:
+            def judge(batch):
+                passages = [passage for _, _, _, passage in batch if passage is not None]
+                results, prompt_tokens = judge_quality_batch(client, model, passages, rate_limiter) if passages else ([], 0)
+                results = iter(results)
+                resumed_in_batch = 0
+                for _, uid, rejected_by, passage in batch:
+                    if passage is None and uid in verdicts:
+                        resumed_in_batch += 1
+                        continue
+                    high_quality = passage is not None and next(results)
+                    entry = {"uid": uid, "quality": "high-quality" if high_quality else "low-quality", "rejected_by": rejected_by}
+                    if passage is not None:
+                        # Estimated tokens of the request(s) this record was judged in, shared by the whole batch.
+                        entry["prompt_tokens"] = prompt_tokens
+                        entry["batch_size"] = len(passages)
+                    with journal_lock:
+                        journal.write(json.dumps(entry) + "\n")
+                        journal.flush()
+                        verdicts[uid] = entry
+                if passages:
+                    with journal_lock:
+                        request_counts["requests"] += 1
+                        request_counts["prompt_tokens"] += prompt_tokens
+                return resumed_in_batch
+
+            def track_sources(records):
+                for record in records:
+                    source_files.add(record.get("sourceFile", ""))
+                    yield record
+
+            # input_file may be a JSON array, a JSONL file or a folder of JSONL shards.
+            data = track_sources(iter_records(input_file))
+
+            # The heuristic prefilter runs ahead of the judge, so rejected records are never serialized into a prompt.
+            batches = pack_judge_batches(prefilter_records(data, rejection_counts), verdicts, batch_size, batch_token_budget, passage_token_budget)
+            for resumed_in_batch in ordered_map(judge, batches, max_workers):
+                resumed += resumed_in_batch
+
+        if resumed:
+            print(f"Reused {resumed} verdict(s) from {journal_file}")
+
+        if request_counts["requests"]:
+            print(f"Judged records in {request_counts['requests']} request(s) using ~{request_counts['prompt_tokens']} prompt tokens")
+
+        print(f"Prefilter rejected {sum(rejection_counts.values())} record(s) before the LLM judge:")
+        for rule in PREFILTER_RULES:
+            print(f"  {rule}: {rejection_counts[rule]}")
+
+        source_files.discard("")
+        source_files |= removed_sources or set()
+        materialize_outputs(input_file, verdicts, chat_logs_file, interview_logs_file, csv_output_file, append, source_files, write_parquet)
+
         print(f"Chat logs written to {chat_logs_file}")
         print(f"Interview logs written to {interview_logs_file}")
         print(f"CSV output written to {csv_output_file}")
+        return True
     
     except Exception as e:
         print(f"An error occurred: {e}")
+        return False
 
 # Example usage
 if __name__ == "__main__":
@@ -183,9 +552,7 @@ if __name__ == "__main__":
     csv_output_path = f"{output_folder}/conversation_quality.csv"
 
     load_dotenv("../.env")
-    api_key = os.getenv("BEDROCK_API_KEY")
-    base_url = os.getenv("BEDROCK_BASE_URL")
-    client = OpenAI(api_key=api_key, base_url=base_url)
+    client = get_client("bedrock")
     model = "us.anthropic.claude-3-5-sonnet-20241022-v2:0"
     
     process_logs(client, model, input_file_path, chat_logs_path, interview_logs_path, csv_output_path)
@@ -1,33 +1,337 @@
+import io
 import os
 import json
+import gzip
+import glob
 import random
+import hashlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
-def fetch_conversations_from_folder(input_folder: str, output_file: str):
+from columnar import iter_parquet_records, parquet_num_rows, read_parquet_row
+
+# Bytes just before a resume position that are hashed to check the records before it are still in place.
+FINGERPRINT_BLOCK = 4096
+
+def open_text(path: str, mode: str = "r"):
+    """
+    Open a text file, transparently handling gzip-compressed files.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def list_conversation_files(input_folder: str):
+    """
+    List the JSON log files in a folder in a stable (sorted) order.
+    """
+    return sorted(
+        os.path.join(input_folder, filename)
+        for filename in os.listdir(input_folder)
+        if filename.endswith(".json")
+    )
+
+def load_conversation_file(file_path: str):
+    """
+    Decode a single conversation log. Returns None if the file is not valid JSON.
+    The record is tagged with the name of the log file it came from.
+    """
+    with open(file_path, 'rb') as infile:
+        return decode_conversation(file_path, infile.read())
+
+def decode_conversation(file_path: str, raw: bytes):
+    """
+    Decode the raw bytes of a conversation log and tag it with its source file name.
+    """
+    try:
+        data = json.loads(raw)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        print(f"Error decoding {os.path.basename(file_path)}: {e}")
+        return None
+    if isinstance(data, dict):
+        data["sourceFile"] = os.path.basename(file_path)
+    return data
+
+def load_manifest(manifest_file: str):
+    """
+    Load the manifest of previously ingested files: { file name: {"size", "mtime", "sha256"} }.
+    """
+    if not manifest_file or not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest_file: str, manifest: dict):
+    """
+    Atomically write the manifest so that an interrupted run never leaves it half-written.
+    """
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+def removed_sources(manifest_file: str, pending_manifest: dict):
+    """
+    Names of the log files recorded in the saved manifest that are missing from the pending one (deleted since the last run).
+    """
+    return set(load_manifest(manifest_file)) - set(pending_manifest)
+
+def load_changed_conversation(file_path: str, entry: dict = None):
+    """
+    Load a log file and compare it against its manifest entry.
+    Returns (data, new_entry); data is None if the content hash is unchanged or the file is invalid.
+    """
+    stat = os.stat(file_path)
+    with open(file_path, 'rb') as infile:
+        raw = infile.read()
+    new_entry = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": hashlib.sha256(raw).hexdigest()}
+    if entry and entry.get("sha256") == new_entry["sha256"]:
+        # Only the metadata changed (e.g. the file was touched or copied).
+        return None, new_entry
+    return decode_conversation(file_path, raw), new_entry
+
+def find_candidate_files(file_paths, manifest: dict):
+    """
+    Cheaply select files that may be new or changed: anything whose size or mtime differs from the manifest.
+    Files that match on both are assumed unchanged and are never opened.
+    """
+    candidates = []
+    for file_path in file_paths:
+        entry = manifest.get(os.path.basename(file_path))
+        stat = os.stat(file_path)
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+            continue
+        candidates.append(file_path)
+    return candidates
+
+def iter_changed_conversations(file_paths, manifest: dict, mapper=map):
+    """
+    Yield the records of new or changed log files, updating the manifest in place.
+    Entries for files that no longer exist are dropped from the manifest.
+    """
+    present = {os.path.basename(file_path) for file_path in file_paths}
+    for file_name in list(manifest):
+        if file_name not in present:
+            del manifest[file_name]
+
+    candidates = find_candidate_files(file_paths, manifest)
+    entries = [manifest.get(os.path.basename(file_path)) for file_path in candidates]
+    for file_path, (data, entry) in zip(candidates, mapper(load_changed_conversation, candidates, entries)):
+        manifest[os.path.basename(file_path)] = entry
+        if data is not None:
+            yield data
+
+def fetch_conversations_from_folder(input_folder: str, output_file: str, manifest_file: str = None):
     """
     Fetch conversations from a local folder and compile them into a single JSON file.
+    If a manifest file is given, only new or changed logs are written (a delta batch), and the updated manifest is
+    returned without being saved: the caller saves it (save_manifest) once the delta has been processed, so a
+    failed run ingests the same logs again.
     """
     try:
         conversations = []
+        file_paths = list_conversation_files(input_folder)
 
-        for filename in os.listdir(input_folder):
-            if filename.endswith(".json"):
-                file_path = os.path.join(input_folder, filename)
-                with open(file_path, 'r', encoding='utf-8') as infile:
-                    try:
-                        data = json.load(infile)
-                        conversations.append(data)
-                    except json.JSONDecodeError as e:
-                        print(f"Error decoding {filename}: {e}")
+        if manifest_file:
+            manifest = load_manifest(manifest_file)
+            records = iter_changed_conversations(file_paths, manifest)
+        else:
+            records = (load_conversation_file(file_path) for file_path in file_paths)
+
+        for data in records:
+            if data is not None:
+                conversations.append(data)
 
         # Write data to a JSON file
         with open(output_file, "w", encoding="utf-8") as outfile:
             json.dump(conversations, outfile, indent=4)
 
         print(f"data successfully saved to {output_file}")
+        if manifest_file:
+            print(f"{len(conversations)} new or changed conversation(s) out of {len(file_paths)} log file(s)")
+            return manifest
 
     except Exception as e:
         print(f"Error fetching data from database: {e}")
 
+def write_conversation_shards(input_folder: str, output_folder: str, shard_size: int = 1000, compress: bool = False, max_workers: int = None, manifest_file: str = None):
+    """
+    Decode conversation logs in parallel and stream them into sharded JSONL files
+    (conversations-00000.jsonl, ...), optionally gzip-compressed.
+    Only one shard is held open at a time, so memory does not grow with the corpus.
+    If a manifest file is given, only new or changed logs are written.
+    Returns the list of shard paths and the updated manifest (None without a manifest file), which the caller
+    saves once the shards have been processed.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Remove shards from a previous run so that readers do not pick up stale data.
+    for stale_shard in glob.glob(os.path.join(output_folder, "conversations-*.jsonl*")):
+        os.remove(stale_shard)
+
+    extension = ".jsonl.gz" if compress else ".jsonl"
+    file_paths = list_conversation_files(input_folder)
+    manifest = load_manifest(manifest_file) if manifest_file else None
+    shard_paths = []
+    shard = None
+    shard_count = 0
+
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # map() preserves the input order, so shards are deterministic.
+            if manifest is not None:
+                records = iter_changed_conversations(file_paths, manifest, partial(executor.map, chunksize=64))
+            else:
+                records = executor.map(load_conversation_file, file_paths, chunksize=64)
+            for data in records:
+                if data is None:
+                    continue
+                if shard is None or shard_count >= shard_size:
+                    if shard is not None:
+                        shard.close()
+                    shard_path = os.path.join(output_folder, f"conversations-{len(shard_paths):05d}{extension}")
+                    shard = open_text(shard_path, "w")
+                    shard_paths.append(shard_path)
+                    shard_count = 0
+                shard.write(json.dumps(data) + "\n")
+                shard_count += 1
+    finally:
+        if shard is not None:
+            shard.close()
+
+    print(f"data successfully saved to {len(shard_paths)} shard(s) in {output_folder}")
+    return shard_paths, manifest
+
+def iter_json_array(infile, chunk_size: int = 1 << 16, started: bool = False):
+    """
+    Yield the items of a JSON array one at a time, reading the file in chunks,
+    so memory is bounded by the largest item rather than the whole array.
+    With started set, infile is positioned inside the array (after its opening bracket or an item).
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        # Grow the read with the buffer so that a large item is not re-parsed once per chunk.
+        chunk = infile.read(max(chunk_size, len(buffer) - position))
+        buffer = buffer[position:] + chunk
+        position = 0
+        eof = not chunk
+
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n":
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            read_more()
+            continue
+        if not started:
+            if buffer[position] != "[":
+                raise ValueError("Expected a JSON array")
+            started = True
+            position += 1
+            continue
+        if buffer[position] == "]":
+            return
+        if buffer[position] == ",":
+            position += 1
+            continue
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_more()
+            continue
+        following = end
+        while following < len(buffer) and buffer[following] in " \t\r\n":
+            following += 1
+        if not eof and (following == len(buffer) or buffer[following] not in ",]"):
+            # A number cut off at the end of the buffer (e.g. "1500." of "1500.0") decodes as a shorter value.
+            read_more()
+            continue
+        position = end
+        yield item
+
+def iter_records(path: str):
+    """
+    Yield records one at a time from a JSON array file, a JSONL file (optionally .gz),
+    a Parquet file, or a folder of JSONL shards. No input is ever fully loaded into memory.
+    """
+    if os.path.isdir(path):
+        shard_paths = sorted(glob.glob(os.path.join(path, "*.jsonl")) + glob.glob(os.path.join(path, "*.jsonl.gz")))
+        for shard_path in shard_paths:
+            yield from iter_records(shard_path)
+    elif path.endswith(".jsonl") or path.endswith(".jsonl.gz"):
+        with open_text(path) as infile:
+            for line in infile:
+                if line.strip():
+                    yield json.loads(line)
+    elif path.endswith(".parquet"):
+        yield from iter_parquet_records(path)
+    else:
+        with open_text(path) as infile:
+            yield from iter_json_array(infile)
+
+def records_end(path: str):
+    """
+    Position just after the last record of a JSON array, JSONL or Parquet file: a byte offset for
+    the JSON formats and a row count for Parquet. Files written by appending records keep the
+    records before this position in place. Returns None for gzip-compressed files and folders of
+    shards, which can't be read from a position.
+    """
+    if os.path.isdir(path) or path.endswith(".gz"):
+        return None
+    if path.endswith(".parquet"):
+        return parquet_num_rows(path)
+    size = os.path.getsize(path)
+    if path.endswith(".jsonl"):
+        return size
+    # A JSON array ends with "]"; its last record ends at the last non-whitespace byte before it.
+    start = max(0, size - FINGERPRINT_BLOCK)
+    with open(path, "rb") as f:
+        f.seek(start)
+        tail = f.read().rstrip()
+    if not tail.endswith(b"]"):
+        raise ValueError(f"{path} is not a JSON array")
+    return start + len(tail[:-1].rstrip())
+
+def prefix_fingerprint(path: str, position: int) -> str:
+    """
+    Hash of the FINGERPRINT_BLOCK bytes (or for Parquet, the row) just before a position returned by records_end.
+    """
+    if path.endswith(".parquet"):
+        row = read_parquet_row(path, position - 1) if position else None
+        data = json.dumps(row, sort_keys=True, default=str).encode("utf-8")
+    else:
+        with open(path, "rb") as f:
+            f.seek(max(0, position - FINGERPRINT_BLOCK))
+            data = f.read(min(position, FINGERPRINT_BLOCK))
+    return hashlib.sha256(data).hexdigest()
+
+def iter_records_from(path: str, position: int):
+    """
+    Yield the records after a position returned by records_end, without reading the ones before it.
+    """
+    if path.endswith(".parquet"):
+        yield from iter_parquet_records(path, start=position)
+        return
+    raw = open(path, "rb")
+    raw.seek(position)
+    with io.TextIOWrapper(raw, encoding="utf-8") as infile:
+        if path.endswith(".jsonl"):
+            for line in infile:
+                if line.strip():
+                    yield json.loads(line)
+        elif position:
+            yield from iter_json_array(infile, started=True)
+        else:
+            yield from iter_json_array(infile)
+
 # Example usage
 if __name__ == "__main__":
     input_folder = "logs"
@@ -1,14 +1,19 @@
+import io
 import json
 import csv
-from openai import OpenAI
 import os
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from dotenv import load_dotenv
 import numpy as np
-import pandas as pd
 
-from rating_averages import get_rating, parse_rating
+from rating_averages import get_rating, get_ratings, parse_rating
 from dimensions import DIMENSIONS
+from get_data import iter_records
+from llm_client import RateLimiter, chat_completion, ordered_map, get_client
 
 allowed_models = set([
     "us.anthropic.claude-3-5-sonnet-20241022-v2:0",
@@ -28,7 +33,20 @@ def join_message_content(messages):
             message['content'] = "\n".join(item['text'] for item in message['content'])
     return messages
 
-def classify_message_class(client, messages, model):
+# Class types the interview questions are classified into.
+class_types = (
+    "RQ1: Question asking the user about how well the ChatBot understood the user's question or request.\n"
+    "RQ2: Question asking the user about how well the ChatBot met their needs or solved their problems.\n"
+    "RQ3: Question asking the user about how well the ChatBot provided coherent, factual, and relevant information.\n"
+    "RQ4: Question asking the user about how they would rate their satisfaction.\n"
+    "RQ5: Question asking the user about how the ChatBot can be improved.\n"
+    "RQ6: General question asking the user about what they think about the ChatBot, overall experience, feelings\n"
+    "WILD: Other questions, are you ready questions, thanking the user\n"
+)
+
+VALID_CLASSES = list(DIMENSIONS.keys()) + ["WILD"]
+
+def classify_message_class(client, messages, model, rate_limiter: RateLimiter = None):
     """
     Classify the interview question and answer pairs into different dimensions.
     """
@@ -38,28 +56,17 @@ def classify_message_class(client, messages, model):
             classification_prompt = (
                 "A group of users have been interviewed on their experience using a ChatBot. The interviewer's messages (questions) are marked with 'role': 'assistant', "
                 "and the user's responses are marked with 'role': 'user'. Classify the last interview question in the chat history based on these types:\n"
-                "RQ1: Question asking the user about how well the ChatBot understood the user's question or request.\n"
-                "RQ2: Question asking the user about how well the ChatBot met their needs or solved their problems.\n"
-                "RQ3: Question asking the user about how well the ChatBot provided coherent, factual, and relevant information.\n"
-                "RQ4: Question asking the user about how they would rate their satisfaction.\n"
-                "RQ5: Question asking the user about how the ChatBot can be improved.\n"
-                "RQ6: General question asking the user about what they think about the ChatBot, overall experience, feelings\n"
-                "WILD: Other questions, are you ready questions, thanking the user\n"
+                f"{class_types}"
                 "Chat history:\n"
                 f"{json.dumps(messages[:i + 1], indent=2)}\n\n"
                 "Output the class type and nothing else."
             )
 
             try:
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": "You are a UX researcher. You are an expert at summarizing insights and themes from user experience interviews."},
-                        {"role": "user", "content": classification_prompt},
-                    ]
-                )
-
-                response_content = response.choices[0].message.content.strip()
+                response_content = chat_completion(client, model, [
+                    {"role": "system", "content": "You are a UX researcher. You are an expert at summarizing insights and themes from user experience interviews."},
+                    {"role": "user", "content": classification_prompt},
+                ], rate_limiter)
                 # Determine classification based on response content
                 class_name = next((key for key in DIMENSIONS.keys() if key in response_content), "WILD")
                 classifications.append({
@@ -72,119 +79,463 @@ def classify_message_class(client, messages, model):
                 raise Exception(f"Failed to classify message: {e}")
     return classifications
 
-def save_results_as_csv(output_prefix, classifications):
+def qa_pair_indices(messages):
+    """
+    Indices of interview questions: assistant messages immediately followed by a user answer.
+    """
+    return [i for i in range(len(messages) - 1) if messages[i]['role'] == 'assistant' and messages[i + 1]['role'] == 'user']
+
+def parse_class_list(response_content: str, count: int):
     """
-    Save classifications as a CSV file.
+    Parses a JSON list of class types and validates it against the known classes.
+    Returns None if the list is malformed, has the wrong length or contains an unknown class.
     """
-    # Save classifications
-    with open(f"{output_prefix}_classifications.csv", "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=["question", "answer", "classification"])
-        writer.writeheader()
-        writer.writerows(classifications)
+    start, end = response_content.find("["), response_content.rfind("]")
+    if start == -1 or end < start:
+        return None
+    try:
+        labels = json.loads(response_content[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(labels, list) or len(labels) != count:
+        return None
+    labels = [str(label).strip().upper() for label in labels]
+    if any(label not in VALID_CLASSES for label in labels):
+        return None
+    return labels
+
+def classify_interview(client, messages, model, rate_limiter: RateLimiter = None):
+    """
+    Classify all question and answer pairs of an interview in a single request.
+    Falls back to classify_message_class (one request per pair) if the response does not validate.
+    """
+    indices = qa_pair_indices(messages)
+    if not indices:
+        return []
+
+    question_indices = set(indices)
+    transcript = []
+    question_number = 0
+    for i, message in enumerate(messages):
+        if i in question_indices:
+            question_number += 1
+            transcript.append({"question_number": question_number, **message})
+        else:
+            transcript.append(message)
+
+    classification_prompt = (
+        "A group of users have been interviewed on their experience using a ChatBot. The interviewer's messages (questions) are marked with 'role': 'assistant', "
+        "and the user's responses are marked with 'role': 'user'. Classify every numbered interview question in the chat history based on these types:\n"
+        f"{class_types}"
+        "Chat history:\n"
+        f"{json.dumps(transcript, indent=2)}\n\n"
+        f"Output a JSON list of exactly {len(indices)} class types, one per numbered question in order (e.g. [\"RQ1\", \"WILD\"]), and nothing else."
+    )
+
+    try:
+        response_content = chat_completion(client, model, [
+            {"role": "system", "content": "You are a UX researcher. You are an expert at summarizing insights and themes from user experience interviews."},
+            {"role": "user", "content": classification_prompt},
+        ], rate_limiter)
+    except Exception as e:
+        print(f"Failed to classify interview: {e}", flush=True)
+        raise Exception(f"Failed to classify interview: {e}")
 
-def process_classifications_and_ratings(output_folder: str, client, interview_logs_file: str, model: str = "gpt-4o"):
+    labels = parse_class_list(response_content, len(indices))
+    if labels is None:
+        print("Interview classification did not validate; classifying one question at a time.", flush=True)
+        return classify_message_class(client, messages, model, rate_limiter)
+
+    return [
+        {"question": messages[i]['content'], "answer": messages[i + 1]['content'], "classification": label}
+        for i, label in zip(indices, labels)
+    ]
+
+class ClassificationFile:
+    """
+    Streams classifications to a CSV file as they are made and reads single rows back by their (offset, length)
+    in the file, so that the questions and answers to rate are not all kept in memory.
+    Each row is keyed by the record uid and the index of the Q/A pair within the record's interview.
+    The file is written under a .tmp name and moved into place by finish().
+    """
+    fields = ["question", "answer", "classification", "uid", "pair_index"]
+
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self.file = open(output_file + ".tmp", "w+b")
+        self.lock = threading.Lock()
+        self.write_row(self.fields)
+
+    def write_row(self, values) -> tuple:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        data = buffer.getvalue().encode("utf-8")
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            self.file.write(data)
+        return offset, len(data)
+
+    def append(self, classification: dict) -> tuple:
+        """
+        Writes a classification and returns its location (offset, length) in the file.
+        """
+        return self.write_row([classification[field] for field in self.fields])
+
+    def read(self, location: tuple) -> dict:
+        """
+        Reads back the classification written at a location. All values are strings.
+        """
+        offset, length = location
+        with self.lock:
+            self.file.seek(offset)
+            data = self.file.read(length)
+        return dict(zip(self.fields, next(csv.reader(io.StringIO(data.decode("utf-8"), newline="")))))
+
+    def finish(self):
+        """
+        Moves the complete file into place; rows can still be read afterwards.
+        """
+        with self.lock:
+            self.file.close()
+            os.replace(self.output_file + ".tmp", self.output_file)
+            self.file = open(self.output_file, "rb")
+
+    def close(self):
+        self.file.close()
+
+class RatingRows:
+    """
+    The rows of one dimension to rate (question, answer, uid and pair_index), read on demand from a ClassificationFile.
+    Only each row's location and a digest of its question and answer are kept in memory.
+    """
+    fields = ["question", "answer", "uid", "pair_index"]
+
+    def __init__(self, classification_file: ClassificationFile):
+        self.classification_file = classification_file
+        self.locations = []
+        self.keys = []
+
+    def append(self, location: tuple, question: str, answer: str):
+        self.locations.append(location)
+        self.keys.append(hashlib.blake2b(json.dumps([question, answer]).encode("utf-8"), digest_size=16).digest())
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __getitem__(self, index: int) -> dict:
+        row = self.classification_file.read(self.locations[index])
+        return {field: row[field] for field in self.fields}
+
+def process_classifications_and_ratings(output_folder: str, client, interview_logs_file: str, model: str = "gpt-4o", classification_mode: str = "pair",
+                                        max_workers: int = 1, requests_per_minute: float = None, tokens_per_minute: float = None,
+                                        trial_mode: str = "independent", min_trials: int = 3, model_workers: int = 1):
     """
     Processes each interview record to generate classifications and ratings.
+    classification_mode is "interview" (one request per interview) or "pair" (one request per question, with the history so far).
+    With max_workers > 1, classifications and ratings run concurrently under one shared requests/tokens-per-minute budget.
+    trial_mode selects how rating trials are requested (see process_ratings).
+    With model_workers > 1, up to that many interview models are processed at the same time, all within the same budget.
+    A model that fails is reported and skipped without stopping the others. Returns { model: error } for the failed models.
+    The interview logs are streamed (see get_data.iter_records): each model reads its own records in one pass over the logs,
+    so the logs are never held in memory as a whole.
     """
     try:
-        # Read the interview logs JSON file
-        with open(interview_logs_file, 'r') as file:
-            interview_logs = json.load(file)
-
-        models = {}
-        for record in interview_logs:
-            interview_model = record.get("session_model")
-            if  interview_model not in allowed_models:
-                continue
-            if interview_model not in models:
-                models[interview_model] = []
-            models[interview_model].append(record)
-        for interview_model, interview_logs_per_model in models.items():
-            process_per_model(output_folder, client, interview_logs_per_model, model, interview_model)
+        # Without an explicit quota, requests share the client endpoint's limiter (see llm_client.configure_endpoint).
+        rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute) if requests_per_minute or tokens_per_minute else None
+
+        # Count the records of each interview model
+        models = Counter(
+            record.get("session_model")
+            for record in iter_records(interview_logs_file)
+            if record.get("session_model") in allowed_models
+        )
+
+        def run_model(interview_model):
+            records = (record for record in iter_records(interview_logs_file) if record.get("session_model") == interview_model)
+            process_per_model(output_folder, client, records, model, interview_model, classification_mode, max_workers, rate_limiter, trial_mode, min_trials,
+                              num_records=models[interview_model])
+
+        failures = {}
+        with ThreadPoolExecutor(max_workers=max(1, model_workers)) as executor:
+            futures = {interview_model: executor.submit(run_model, interview_model) for interview_model in models}
+            for interview_model, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[interview_model] = e
+
+        if failures:
+            print(f"Classifications and ratings failed for {len(failures)} of {len(models)} model(s):", flush=True)
+            for interview_model, error in failures.items():
+                print(f"  {interview_model}: {error}", flush=True)
+        return failures
     except Exception as e:
         print(f"An error occurred while processing the interview logs: {e}", flush=True)
         raise Exception(f"An error occurred while processing the interview logs: {e}")
 
-def process_ratings(client, model_name, ratings_by_class, output_folder):
+def trial_settings(dimension):
+    """
+    Returns (number of trials, minimum numeric trials for a valid average) for a dimension.
+    RQ4 asks for an explicit satisfaction rating, so a single trial is enough.
+    """
+    return (5, 3) if dimension != "RQ4" else (1, 1)
+
+def average_rating(trials, nan_threshold):
+    """
+    Averages the numeric trials, or returns NaN if fewer than nan_threshold trials yield a numeric rating.
+    """
+    non_nan_count = sum(not np.isnan(val) for val in trials)
+    if non_nan_count < nan_threshold:
+        return np.nan
+    return np.nanmean(trials)
+
+def should_stop_trials(trials, max_trials, min_trials, nan_threshold):
+    """
+    Decides whether a row needs more rating trials. Stops once at least min_trials trials agree unanimously on
+    a numeric rating (and meet nan_threshold), or once so many trials were NaN that nan_threshold is unreachable.
+    """
+    numeric = [val for val in trials if not np.isnan(val)]
+    if len(numeric) + (max_trials - len(trials)) < nan_threshold:
+        return True
+    return len(trials) >= min_trials and len(numeric) >= nan_threshold and len(set(numeric)) == 1
+
+def run_adaptive_trials(rate_trial, max_trials, min_trials, nan_threshold):
+    """
+    Runs trials one at a time (rate_trial(trial) returns a parsed rating) until should_stop_trials says the
+    outcome is settled or max_trials is reached. Returns the ratings of the trials actually run.
+    """
+    trials = []
+    for trial in range(max_trials):
+        trials.append(rate_trial(trial))
+        if should_stop_trials(trials, max_trials, min_trials, nan_threshold):
+            break
+    return trials
+
+def format_rating_value(value):
+    """
+    Formats a value the way pandas writes it to CSV (NaN as an empty field).
+    """
+    if isinstance(value, float) and np.isnan(value):
+        return ""
+    return value
+
+class RatingWriter:
+    """
+    Streams one dimension's ratings CSV to disk in row order as rating groups complete.
+    Only a compact row -> group index and the results of groups with unwritten rows are kept in memory.
+    Rows left by an interrupted run are kept as long as they match the current rows, and rating resumes after them.
+    """
+    def __init__(self, output_file: str, rows: list, group_of_row: list, num_trials: int, nan_threshold: int, with_trials_used: bool = False):
+        self.output_file = output_file
+        self.rows = rows
+        self.group_of_row = group_of_row
+        self.num_trials = num_trials
+        self.nan_threshold = nan_threshold
+        self.with_trials_used = with_trials_used
+        self.row_fields = list(rows[0].keys())
+        self.fields = self.row_fields + ["rating"] + [f"trial_{i+1}" for i in range(num_trials)] + (["trials_used"] if with_trials_used else [])
+
+        # The last row of each group, after which its results can be dropped.
+        self.last_row_of_group = {group: index for index, group in enumerate(group_of_row)}
+        self.group_results = {}
+
+        self.written = self.resume()
+        self.file = open(output_file, "a", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file, lineterminator="\n")
+        if self.written == 0:
+            self.writer.writerow(self.fields)
+            self.file.flush()
+
+    def resume(self) -> int:
+        """
+        Keeps the prefix of an existing output file whose rows match the current rows and returns its length.
+        """
+        if not os.path.exists(self.output_file):
+            return 0
+        kept = 0
+        tmp_file = self.output_file + ".tmp"
+        with open(self.output_file, "r", newline="", encoding="utf-8") as infile, \
+                open(tmp_file, "w", newline="", encoding="utf-8") as outfile:
+            reader = csv.reader(infile)
+            writer = csv.writer(outfile, lineterminator="\n")
+            if next(reader, None) == self.fields:
+                writer.writerow(self.fields)
+                for existing in reader:
+                    if kept >= len(self.rows) or len(existing) != len(self.fields):
+                        break
+                    if existing[:len(self.row_fields)] != [str(self.rows[kept][field]) for field in self.row_fields]:
+                        break
+                    writer.writerow(existing)
+                    kept += 1
+        if kept == 0:
+            os.remove(tmp_file)
+            os.remove(self.output_file)
+        else:
+            os.replace(tmp_file, self.output_file)
+        return kept
+
+    def pending_groups(self):
+        """
+        Groups that still have unwritten rows, in order of their first unwritten row.
+        """
+        return list(dict.fromkeys(self.group_of_row[self.written:]))
+
+    def complete(self, group: int, trials):
+        """
+        Records the trial ratings of a group and writes every row that is now ready.
+        """
+        self.group_results[group] = trials
+        while self.written < len(self.rows) and self.group_of_row[self.written] in self.group_results:
+            index = self.written
+            group_of_index = self.group_of_row[index]
+            trials = self.group_results[group_of_index]
+            values = [self.rows[index][field] for field in self.row_fields] + [average_rating(trials, self.nan_threshold)]
+            values += list(trials) + [np.nan] * (self.num_trials - len(trials))
+            if self.with_trials_used:
+                values.append(len(trials))
+            self.writer.writerow([format_rating_value(value) for value in values])
+            self.file.flush()
+            if self.last_row_of_group[group_of_index] == index:
+                del self.group_results[group_of_index]
+            self.written += 1
+
+    def close(self):
+        self.file.close()
+
+def process_ratings(client, model_name, ratings_by_class, output_folder, max_workers: int = 1, rate_limiter: RateLimiter = None, trial_mode: str = "independent",
+                    min_trials: int = 3):
     """
     Generates one set of ratings for a specified model.
+    With trial_mode "independent", every (dimension, row, trial) rating is its own request; with "multi_sample",
+    all trials of a row come from one request (see get_ratings); with "adaptive", each row runs between
+    min_trials and the dimension's number of trials, stopping early once the outcome is settled, and the
+    number of trials used is written to a trials_used column. With max_workers > 1 the requests run
+    concurrently within the shared rate limiter's budget.
+    Rows of a dimension with the same question and answer are rated once, and the ratings are copied to every occurrence.
+    Each row is appended to its dimension's CSV file as soon as it and all rows before it are rated, so an interrupted
+    run keeps its completed ratings and a rerun resumes after the last written row.
+    ratings_by_class maps each dimension to its RatingRows; only row indices are kept in memory, and the question
+    and answer of a row are read when it is rated or written. Rating requests are generated as they are sent.
     """
-    for dimension, ratings in ratings_by_class.items():
-        num_trials = 5 if dimension != "RQ4" else 1
-        nan_threshold = 3 if dimension != "RQ4" else 1
-        trial_results = {f"trial_{i+1}": [] for i in range(num_trials)}
-        avg_ratings = []
-
-        ratings_df = pd.DataFrame(ratings)
-
-        for index, row in tqdm(ratings_df.iterrows(), total=ratings_df.shape[0]):
-            question = row["question"]
-            answer = row["answer"]
-            trials = []
-            
-            # Run 5 trials per row.
-            for i in range(num_trials):
-                rating_str = get_rating(client, dimension, question, answer)
-                rating_val = parse_rating(rating_str)
-                trials.append(rating_val)
-            
-            # If fewer than 3 trials yield a numeric rating, set the average to NaN.
-            non_nan_count = sum(not np.isnan(val) for val in trials)
-            if non_nan_count < nan_threshold:
-                avg_rating = np.nan
-            else:
-                avg_rating = np.nanmean(trials)
-                
-            avg_ratings.append(avg_rating)
-            for i, rating in enumerate(trials):
-                trial_results[f"trial_{i+1}"].append(rating)
-        
-        # Update dataframe with the new ratings.
-        ratings_df["rating"] = avg_ratings
-        for col, values in trial_results.items():
-            ratings_df[col] = values
-        
-        # Ensure the output folder exists.
-        os.makedirs(output_folder, exist_ok=True)
-        output_file = os.path.join(output_folder, os.path.basename(f"{model_name}_ratings_{dimension}.csv"))
-        ratings_df.to_csv(output_file, index=False)
-        print(f"Finished processing file. Output written to {output_file}.")
-
-def process_per_model(output_folder, client, interview_logs: list, model: str = "gpt-4o", filter_model: str = None):
+    os.makedirs(output_folder, exist_ok=True)
+    writers = {}
+    plans = []
+    total = 0
+    try:
+        for dimension, ratings in ratings_by_class.items():
+            num_trials, nan_threshold = trial_settings(dimension)
+
+            # Number the distinct (question, answer) rows of the dimension in first-occurrence order.
+            group_ids = {}
+            group_of_row = [group_ids.setdefault(key, len(group_ids)) for key in ratings.keys]
+            first_row_of_group = {}
+            for index, group in enumerate(group_of_row):
+                first_row_of_group.setdefault(group, index)
+
+            output_file = os.path.join(output_folder, os.path.basename(f"{model_name}_ratings_{dimension}.csv"))
+            writer = RatingWriter(output_file, ratings, group_of_row, num_trials, nan_threshold, trial_mode == "adaptive")
+            writers[dimension] = writer
+            if writer.written:
+                print(f"Resuming {output_file} after {writer.written} of {len(ratings)} rows.")
+
+            groups = writer.pending_groups()
+            if len(groups) < len(ratings) - writer.written:
+                print(f"Rating {len(groups)} distinct rows out of {len(ratings) - writer.written} for {dimension}.")
+            plans.append((dimension, groups, first_row_of_group))
+            total += len(groups) if trial_mode in ("multi_sample", "adaptive") else len(groups) * num_trials
+
+        def iter_jobs():
+            for dimension, groups, first_row_of_group in plans:
+                if trial_mode in ("multi_sample", "adaptive"):
+                    yield from ((dimension, group, first_row_of_group[group], None) for group in groups)
+                else:
+                    num_trials = trial_settings(dimension)[0]
+                    yield from ((dimension, group, first_row_of_group[group], trial) for group in groups for trial in range(num_trials))
+
+        def rate(job):
+            dimension, _, index, trial = job
+            row = ratings_by_class[dimension][index]
+            if trial_mode == "adaptive":
+                num_trials, nan_threshold = trial_settings(dimension)
+                rate_trial = lambda trial: parse_rating(get_rating(client, dimension, row["question"], row["answer"], trial=trial, rate_limiter=rate_limiter))
+                return job, run_adaptive_trials(rate_trial, num_trials, min(min_trials, num_trials), nan_threshold)
+            if trial is None:
+                num_trials = trial_settings(dimension)[0]
+                return job, [parse_rating(rating) for rating in get_ratings(client, dimension, row["question"], row["answer"], num_trials, rate_limiter=rate_limiter)]
+            return job, [parse_rating(get_rating(client, dimension, row["question"], row["answer"], trial=trial, rate_limiter=rate_limiter))]
+
+        # In independent mode the trials of a group arrive one job at a time; they are collected here until complete.
+        partial_trials = {}
+        used, budget = 0, 0
+        for (dimension, group, _, trial), rating_vals in tqdm(ordered_map(rate, iter_jobs(), max_workers), total=total, desc=f"{model_name} ratings"):
+            num_trials = trial_settings(dimension)[0]
+            if trial is None:
+                used += len(rating_vals)
+                budget += num_trials
+                writers[dimension].complete(group, rating_vals)
+                continue
+            trials = partial_trials.setdefault((dimension, group), [np.nan] * num_trials)
+            trials[trial] = rating_vals[0]
+            if trial == num_trials - 1:
+                writers[dimension].complete(group, partial_trials.pop((dimension, group)))
+
+        if trial_mode == "adaptive":
+            print(f"Adaptive rating used {used} of {budget} possible trials.")
+    finally:
+        for dimension, writer in writers.items():
+            writer.close()
+            if writer.written == len(ratings_by_class[dimension]):
+                print(f"Finished processing file. Output written to {writer.output_file}.")
+
+def process_per_model(output_folder, client, interview_logs, model: str = "gpt-4o", filter_model: str = None, classification_mode: str = "pair",
+                      max_workers: int = 1, rate_limiter: RateLimiter = None, trial_mode: str = "independent", min_trials: int = 3, num_records: int = None):
     """
     Processes interview records for a specified model to generate classifications and ratings.
+    interview_logs can be a list or a lazy iterable of records; num_records is its length if it has none.
     """
     try:
         print(f"Processing interview logs for model: {filter_model}", flush=True)
-        all_classifications = []
+        # Classifications are written as they arrive; ratings keep only where each row is in the file.
+        classification_file = ClassificationFile(f"{output_folder}/{filter_model}_classifications.csv")
         ratings_by_class = {}
 
-        for record in tqdm(interview_logs):
+        def classify(record):
             messages = record.get("interview", [])
 
             # Join the message content
             messages = join_message_content(messages)
 
             # Classify question-answer pairs
-            classifications = classify_message_class(client, messages, model)
-            all_classifications.extend(classifications)
-
-            for classification in classifications:
-                class_name = classification['classification']
-                # These ratings are not used for RQ5 (Improvements) or WILD (Unknown classifications)
-                if class_name in ["RQ5", "WILD"]:
-                    continue
-                question = classification['question']
-                answer = classification['answer']
-
-                # Generate a rating for the specific class
-                if class_name not in ratings_by_class:
-                    ratings_by_class[class_name] = []
-                
-                ratings_by_class[class_name].append({"question": question, "answer": answer})
-  
-        save_results_as_csv(f"{output_folder}/{filter_model}", all_classifications)
-        process_ratings(client, filter_model, ratings_by_class, output_folder)
+            if classification_mode == "interview":
+                classifications = classify_interview(client, messages, model, rate_limiter)
+            else:
+                classifications = classify_message_class(client, messages, model, rate_limiter)
+
+            # Key each pair by its record and position so that later stages can join on them.
+            for pair_index, classification in enumerate(classifications):
+                classification["uid"] = record.get("uid", "nan")
+                classification["pair_index"] = pair_index
+            return classifications
+
+        try:
+            for classifications in tqdm(ordered_map(classify, interview_logs, max_workers), total=num_records if num_records is not None else len(interview_logs), desc=f"{filter_model} classifications"):
+                for classification in classifications:
+                    location = classification_file.append(classification)
+                    class_name = classification['classification']
+                    # These ratings are not used for RQ5 (Improvements) or WILD (Unknown classifications)
+                    if class_name in ["RQ5", "WILD"]:
+                        continue
+
+                    # Generate a rating for the specific class
+                    if class_name not in ratings_by_class:
+                        ratings_by_class[class_name] = RatingRows(classification_file)
+                    ratings_by_class[class_name].append(location, classification['question'], classification['answer'])
+
+            classification_file.finish()
+            process_ratings(client, filter_model, ratings_by_class, output_folder, max_workers, rate_limiter, trial_mode, min_trials)
+        finally:
+            classification_file.close()
 
     except Exception as e:
         print(f"An error occurred while processing the interview logs: {e}")
@@ -196,9 +547,7 @@ if __name__ == "__main__":
     interview_logs_path = f"{output_folder}/interview_logs.json"
     
     load_dotenv("../.env")
-    api_key = os.getenv("BEDROCK_API_KEY")
-    base_url = os.getenv("BEDROCK_BASE_URL")
-    client = OpenAI(api_key=api_key, base_url=base_url)
+    client = get_client("bedrock")
     model = "us.anthropic.claude-3-5-sonnet-20241022-v2:0"
 
     process_classifications_and_ratings(output_folder, client, interview_logs_path, model)
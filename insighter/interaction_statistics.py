@@ -1,165 +1,313 @@
+import os
 import json
-import csv
-from datetime import datetime
-from collections import defaultdict
+import numpy as np
+import pandas as pd
 
-def compute_time_difference(start_time, end_time):
+from get_data import iter_records, iter_records_from, records_end, prefix_fingerprint
+from summary_state import SummaryState
+from token_counter import TokenCounter, count_words
+
+# Per-record statistics, summarized per model and overall. Words are whitespace-separated words;
+# tokens are counted by the configured TokenCounter (equal to words with the "words" backend).
+STAT_FIELDS = ["rounds", "user_words", "assistant_words", "user_tokens", "assistant_tokens", "engagement_time"]
+
+# Per-record flags, totalled per model: records with a missing start or end timestamp, and records whose
+# timestamps cannot be parsed or end before they start. Neither contributes an engagement time.
+TIMESTAMP_COUNTERS = ["missing_timestamps", "invalid_timestamps"]
+
+# Percentiles reported next to the averages.
+PERCENTILES = {"median": 0.5, "p90": 0.9, "p99": 0.99}
+
+# Bin edges (in seconds) of the engagement time histograms.
+ENGAGEMENT_BINS = [0, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, float("inf")]
+
+# Version of the persisted statistics state; states written by another version are rebuilt.
+STATE_VERSION = 5
+
+# How each kind of log is summarized. A round is a message of the first role directly followed by one of the second.
+STATISTICS = {
+    "chat": {
+        "messages_key": "session", "start_key": "session_start", "end_key": "session_end", "round_roles": ("user", "assistant"),
+        "count_field": "number_of_chats", "output": "chat_model_aggregates.csv",
+        "daily_output": "chat_daily_aggregates.csv", "histogram_output": "chat_engagement_histogram.csv",
+    },
+    "interview": {
+        "messages_key": "interview", "start_key": "interview_start", "end_key": "interview_end", "round_roles": ("assistant", "user"),
+        "count_field": "number_of_interviews", "output": "interview_model_aggregates.csv",
+        "daily_output": "interview_daily_aggregates.csv", "histogram_output": "interview_engagement_histogram.csv",
+    },
+}
+
+# Message roles are stored as small integer codes; any other role gets OTHER_ROLE.
+ROLE_CODES = {"user": 0, "assistant": 1}
+OTHER_ROLE = 2
+
+def parse_timestamps(values):
     """
-    Simple utility function to compute the time difference from two strings.
+    Parse ISO 8601 timestamps of all records at once. Timestamps without a UTC offset are taken as UTC.
+    Returns the parsed timestamps (NaT where missing or unparseable) and a mask of the missing ones.
     """
-    start = datetime.fromisoformat(start_time.strip("Z"))
-    end = datetime.fromisoformat(end_time.strip("Z"))
-    return (end - start).total_seconds()
+    values = pd.Series(values, dtype=object)
+    missing = (values.isna() | (values.astype(str).str.strip() == "")).to_numpy()
+    return pd.to_datetime(values.where(~missing), errors="coerce", utc=True, format="ISO8601"), missing
 
-def compute_tokens(text):
+def engagement_times(records, start_key, end_key):
     """
-    Compute tokens as the number of words.
+    Compute the engagement time (seconds from start to end) of every record at once, and the calendar day
+    (UTC date of the start, or of the end if the start is unusable) each record is bucketed under.
+    Returns the engagement times (NaN where unknown), the days ("unknown" if neither timestamp parses),
+    and the missing and invalid timestamp flags.
     """
-    return len(text.split())
+    start, start_missing = parse_timestamps([record.get(start_key) for record in records])
+    end, end_missing = parse_timestamps([record.get(end_key) for record in records])
+    missing = start_missing | end_missing
+    seconds = ((end - start).dt.total_seconds()).to_numpy(dtype=float)
+    invalid = ~missing & (np.isnan(seconds) | (seconds < 0))
+    seconds = np.where(missing | invalid, np.nan, seconds)
+    days = start.fillna(end).dt.strftime("%Y-%m-%d").fillna("unknown").to_numpy(dtype=object)
+    return seconds, days, missing, invalid
 
-def compute_message_tokens(content):
+def message_texts(content):
     """
-    Compute tokens for a message.
+    The text parts of a message's content (a string, or a list of strings and {"text": ...} parts).
     """
     if isinstance(content, list):
-        total_tokens = sum(compute_tokens(part['text']) if isinstance(part, dict) and 'text' in part else compute_tokens(part) for part in content if isinstance(part, (str, dict)))
-        return total_tokens
+        return [
+            part['text'] if isinstance(part, dict) else part
+            for part in content
+            if isinstance(part, str) or (isinstance(part, dict) and 'text' in part)
+        ]
     elif isinstance(content, str):
-        return compute_tokens(content)
-    return 0
+        return [content]
+    return []
 
-def compute_rounds(session, role1, role2):
+def flatten_messages(records, messages_key, token_counter):
     """
-    Compute the number of rounds for a given session.
+    Flatten the messages of all records into typed arrays: record index, role code, word count and token count per message.
+    The text parts of all messages are counted in one batch.
     """
-    count = 0
-    prev_role = None
-    for message in session:
-        if prev_role == role1 and message.get('role') == role2:
-            count += 1
-        prev_role = message.get('role')
-    return count
+    record_ids = []
+    roles = []
+    texts = []
+    message_of_text = []
+    for index, record in enumerate(records):
+        messages = record.get(messages_key) or []
+        for message in messages:
+            parts = message_texts(message.get('content'))
+            message_of_text.extend([len(roles)] * len(parts))
+            texts.extend(parts)
+            record_ids.append(index)
+            roles.append(ROLE_CODES.get(message.get('role'), OTHER_ROLE))
+    message_of_text = np.array(message_of_text, dtype=np.int64)
+    words = np.bincount(message_of_text, weights=count_words(texts), minlength=len(roles)).astype(np.int64)
+    tokens = np.bincount(message_of_text, weights=token_counter.count_many(texts), minlength=len(roles)).astype(np.int64)
+    return np.array(record_ids, dtype=np.int64), np.array(roles, dtype=np.int8), words, tokens
 
-def compute_session_statistics(session_data):
+def count_rounds(record_ids, roles, first_role, second_role, num_records):
     """
-    Compute chat statistics.
+    Count, per record, the messages with second_role that directly follow a message with first_role.
     """
-    session = session_data.get("session", [])
-    session_start = session_data.get("session_start")
-    session_end = session_data.get("session_end")
-    session_model = session_data.get("session_model", "unknown")
+    follows = (record_ids[1:] == record_ids[:-1]) & (roles[:-1] == ROLE_CODES[first_role]) & (roles[1:] == ROLE_CODES[second_role])
+    return np.bincount(record_ids[1:][follows], minlength=num_records)
 
-    if not session:
-        return {"session_model": session_model, "rounds": 0, "user_tokens": 0, "assistant_tokens": 0, "engagement_time": 0}
+def record_statistics(records, messages_key, start_key, end_key, first_role, second_role, token_counter=None):
+    """
+    Compute the statistics of every record at once from the flattened messages and timestamps.
+    A round is a first_role message directly followed by a second_role message.
+    Returns a DataFrame with session_model and day columns, one column per STAT_FIELDS entry and one per TIMESTAMP_COUNTERS entry.
+    Records without usable timestamps have no engagement time (NaN), so they are left out of its averages and percentiles.
+    Tokens are counted with token_counter (by default, as words).
+    """
+    num_records = len(records)
+    record_ids, roles, words, tokens = flatten_messages(records, messages_key, token_counter or TokenCounter())
+    engagement_time, days, missing, invalid = engagement_times(records, start_key, end_key)
 
-    user_tokens = sum(compute_message_tokens(msg['content']) for msg in session if msg.get('role') == 'user')
-    assistant_tokens = sum(compute_message_tokens(msg['content']) for msg in session if msg.get('role') == 'assistant')
-    engagement_time = compute_time_difference(session_start, session_end) if session_start and session_end else 0
-    rounds = compute_rounds(session, 'user', 'assistant')
+    return pd.DataFrame({
+        "session_model": [record.get("session_model", "unknown") for record in records],
+        "day": days,
+        "rounds": count_rounds(record_ids, roles, first_role, second_role, num_records),
+        "user_words": np.bincount(record_ids, weights=words * (roles == ROLE_CODES["user"]), minlength=num_records).astype(np.int64),
+        "assistant_words": np.bincount(record_ids, weights=words * (roles == ROLE_CODES["assistant"]), minlength=num_records).astype(np.int64),
+        "user_tokens": np.bincount(record_ids, weights=tokens * (roles == ROLE_CODES["user"]), minlength=num_records).astype(np.int64),
+        "assistant_tokens": np.bincount(record_ids, weights=tokens * (roles == ROLE_CODES["assistant"]), minlength=num_records).astype(np.int64),
+        "engagement_time": engagement_time,
+        "missing_timestamps": missing.astype(np.int64),
+        "invalid_timestamps": invalid.astype(np.int64),
+    })
 
-    return {"session_model": session_model, "rounds": rounds, "user_tokens": user_tokens, "assistant_tokens": assistant_tokens, "engagement_time": engagement_time}
+def new_states():
+    """
+    Empty summary states: one per model, and one per calendar day and model.
+    """
+    return SummaryState(STAT_FIELDS, TIMESTAMP_COUNTERS), SummaryState(STAT_FIELDS, TIMESTAMP_COUNTERS, keys=["day", "session_model"])
 
-def compute_interview_statistics(interview_data):
+def summary_row(group, count_field):
     """
-    Compute interview statistics.
+    The number of records, the missing and invalid timestamp counts, and the average, median, p90, p99
+    and standard deviation of each statistic of one state group. Percentiles are approximate (within 1%).
     """
-    interview = interview_data.get("interview", [])
-    session_model = interview_data.get("session_model", "unknown")
+    summaries = group["fields"]
+    row = {count_field: summaries[STAT_FIELDS[0]].count}
+    row.update(group["counters"])
+    row.update({f"average_{field}": summaries[field].mean() for field in STAT_FIELDS})
+    for name, q in PERCENTILES.items():
+        row.update({f"{name}_{field}": summaries[field].quantile(q) for field in STAT_FIELDS})
+    row.update({f"std_{field}": summaries[field].std() for field in STAT_FIELDS})
+    return row
 
-    if not interview:
-        return {"session_model": session_model, "rounds": 0, "user_tokens": 0, "assistant_tokens": 0, "engagement_time": 0, "session_model": session_model}
+def summary_table(state, count_field):
+    """
+    Per-model and overall ("Overall") summary of a per-model SummaryState.
+    """
+    groups = [(key[0], group) for key, group in state.groups.items()] + [("Overall", state.overall())]
+    return pd.DataFrame([dict(session_model=model, **summary_row(group, count_field)) for model, group in groups])
 
-    user_tokens = sum(compute_message_tokens(msg['content']) for msg in interview if msg.get('role') == 'user')
-    assistant_tokens = sum(compute_message_tokens(msg['content']) for msg in interview if msg.get('role') == 'assistant')
-    engagement_time = compute_time_difference(interview_data.get("interview_start"), interview_data.get("interview_end")) if interview_data.get("interview_start") and interview_data.get("interview_end") else 0
-    rounds = compute_rounds(interview, 'assistant', 'user')
+def daily_table(daily_state, count_field):
+    """
+    Summary of every (day, model) group of a daily SummaryState, ordered by day.
+    """
+    rows = [dict(day=day, session_model=model, **summary_row(group, count_field)) for (day, model), group in daily_state.groups.items()]
+    return pd.DataFrame(rows, columns=["day", "session_model"] + (list(rows[0])[2:] if rows else [])).sort_values(["day", "session_model"], kind="stable")
 
-    return {"rounds": rounds, "user_tokens": user_tokens, "assistant_tokens": assistant_tokens, "engagement_time": engagement_time, "session_model": session_model}
+def engagement_histogram(state):
+    """
+    Number of records per engagement time bin (ENGAGEMENT_BINS), per model and overall. Counts are approximate near bin edges.
+    """
+    groups = [(key[0], group) for key, group in state.groups.items()] + [("Overall", state.overall())]
+    rows = []
+    for model, group in groups:
+        counts = group["fields"]["engagement_time"].sketch.histogram(ENGAGEMENT_BINS)
+        rows.extend(
+            {"session_model": model, "bin_start": start, "bin_end": end, "count": count}
+            for start, end, count in zip(ENGAGEMENT_BINS[:-1], ENGAGEMENT_BINS[1:], counts)
+        )
+    return pd.DataFrame(rows)
 
-def process_statistics(output_folder, chat_logs_file, interview_logs_file):
+def load_statistics_state(state_file):
+    """
+    Load the persisted statistics state: for "chat" and "interview", the per-model and daily summary states and the position in the logs up to which they cover the records.
+    """
+    if not state_file or not os.path.exists(state_file):
+        return {}
+    with open(state_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_statistics_state(state_file, state):
+    """
+    Atomically write the statistics state so that an interrupted run never leaves it half-written.
+    """
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+def fold_records(logs_file, kind, entry=None, chunk_size=10000, token_counter=None):
+    """
+    Stream the records of a log file (JSON array, JSONL or Parquet) into the summary state of one kind ("chat" or "interview"),
+    chunk_size records at a time, so memory stays bounded regardless of the size of the logs.
+    entry is the persisted state from a previous run. Logs grow by appending, so reading resumes at the position where
+    that run's last record ended, without reading the records before it, as long as the bytes (or row) just before that
+    position are unchanged and the tokens were counted with the same tokenizer. Otherwise (e.g. records of a re-ingested
+    log file were replaced), or for logs that can't be read from a position, the state is rebuilt from all records.
+    Returns the new persisted entry.
+    """
+    settings = STATISTICS[kind]
+    token_counter = token_counter or TokenCounter()
+    end = records_end(logs_file)
+    if entry and entry.get("version") != STATE_VERSION:
+        print(f"The saved {kind} statistics are from an older version; rebuilding them.")
+        entry = None
+    if entry and entry["tokenizer"] != token_counter.name:
+        print(f"The saved {kind} statistics counted tokens with {entry['tokenizer']}, not {token_counter.name}; rebuilding them.")
+        entry = None
+    if entry and (end is None or entry["position"] is None):
+        print(f"The {kind} logs can't be read from a position; rebuilding the {kind} statistics.")
+        entry = None
+    if entry and (entry["position"] > end or prefix_fingerprint(logs_file, entry["position"]) != entry["fingerprint"]):
+        print(f"The {kind} logs changed before the last processed record; rebuilding the {kind} statistics.")
+        entry = None
+
+    if entry:
+        state, daily_state = SummaryState.from_dict(entry["state"]), SummaryState.from_dict(entry["daily"])
+        records = iter_records_from(logs_file, entry["position"])
+    else:
+        state, daily_state = new_states()
+        records = iter_records(logs_file)
+
+    def fold(chunk):
+        stats = record_statistics(chunk, settings["messages_key"], settings["start_key"], settings["end_key"], *settings["round_roles"], token_counter)
+        state.update(stats)
+        daily_state.update(stats)
+
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            fold(chunk)
+            chunk = []
+    if chunk:
+        fold(chunk)
+    fingerprint = prefix_fingerprint(logs_file, end) if end is not None else None
+    return {"version": STATE_VERSION, "tokenizer": token_counter.name, "position": end, "fingerprint": fingerprint, "state": state.to_dict(), "daily": daily_state.to_dict()}
+
+def write_summaries(output_folder, state):
+    """
+    Write the per-model aggregates, daily aggregates and engagement time histograms of each kind
+    (e.g. chat_model_aggregates.csv, chat_daily_aggregates.csv and chat_engagement_histogram.csv) from the persisted state.
+    """
+    for kind, entry in state.items():
+        settings = STATISTICS[kind]
+        model_state = SummaryState.from_dict(entry["state"])
+        summary_table(model_state, settings["count_field"]).to_csv(f"{output_folder}/{settings['output']}", index=False)
+        daily_table(SummaryState.from_dict(entry["daily"]), settings["count_field"]).to_csv(f"{output_folder}/{settings['daily_output']}", index=False)
+        engagement_histogram(model_state).to_csv(f"{output_folder}/{settings['histogram_output']}", index=False)
+        overall = model_state.overall()["counters"]
+        if overall["missing_timestamps"] or overall["invalid_timestamps"]:
+            print(
+                f"{overall['missing_timestamps']} {kind} records have missing timestamps and {overall['invalid_timestamps']} have invalid ones; "
+                "they are left out of the engagement time statistics."
+            )
+        print(f"{kind.capitalize()} statistics saved successfully.")
+
+def merge_statistics_states(output_folder, state_files):
+    """
+    Merge statistics states computed on different shards or workers and write the combined aggregates.
+    Counts and means are exact; percentiles are approximate.
+    """
+    merged = {}
+    tokenizers = {}
+    for state_file in state_files:
+        for kind, entry in load_statistics_state(state_file).items():
+            if entry.get("version") != STATE_VERSION:
+                print(f"Skipping the {kind} statistics in {state_file}: they are from an older version.")
+                continue
+            if tokenizers.setdefault(kind, entry["tokenizer"]) != entry["tokenizer"]:
+                print(f"Skipping the {kind} statistics in {state_file}: they counted tokens with {entry['tokenizer']}, not {tokenizers[kind]}.")
+                continue
+            if kind not in merged:
+                merged[kind] = new_states()
+            merged[kind][0].merge(SummaryState.from_dict(entry["state"]))
+            merged[kind][1].merge(SummaryState.from_dict(entry["daily"]))
+    write_summaries(output_folder, {kind: {"state": state.to_dict(), "daily": daily_state.to_dict()} for kind, (state, daily_state) in merged.items()})
+
+def process_statistics(output_folder, chat_logs_file, interview_logs_file, state_file=None, chunk_size=10000, token_counter=None):
     """
     Compute chat and interview statistics.
+    The logs can be JSON arrays, JSONL or Parquet files; they are streamed chunk_size records at a time.
+    If a state file is given, the mergeable summary state is persisted there, and a rerun only folds in the
+    log records appended since the previous run.
+    Tokens are counted with token_counter (a token_counter.TokenCounter); by default they are counted as words.
     """
-    with open(chat_logs_file, 'r', encoding='utf-8') as chat_file:
-        chat_logs = json.load(chat_file)
-    with open(interview_logs_file, 'r', encoding='utf-8') as interview_file:
-        interview_logs = json.load(interview_file)
-
-    chat_stats = []
-    interview_stats = []
-    chat_aggregates = defaultdict(lambda: {"rounds": 0, "user_tokens": 0, "assistant_tokens": 0, "engagement_time": 0, "count": 0})
-    interview_aggregates = defaultdict(lambda: {"rounds": 0, "user_tokens": 0, "assistant_tokens": 0, "engagement_time": 0, "count": 0})
-
-    overall_chat = {"rounds": 0, "user_tokens": 0, "assistant_tokens": 0, "engagement_time": 0, "count": 0}
-    overall_interview = {"rounds": 0, "user_tokens": 0, "assistant_tokens": 0, "engagement_time": 0, "count": 0}
-
-    for chat_log in chat_logs:
-        chat_statistics = compute_session_statistics(chat_log)
-        chat_stats.append(chat_statistics)
-        model = chat_statistics["session_model"]
-        for key in chat_statistics:
-            if key != "session_model":
-                chat_aggregates[model][key] += chat_statistics[key]
-                overall_chat[key] += chat_statistics[key]
-        chat_aggregates[model]["count"] += 1
-        overall_chat["count"] += 1
-
-    with open(f"{output_folder}/chat_model_aggregates.csv", "w", newline="", encoding="utf-8") as chat_aggregate_csv:
-        writer = csv.DictWriter(chat_aggregate_csv, fieldnames=["session_model", "number_of_chats", "average_rounds", "average_user_tokens", "average_assistant_tokens", "average_engagement_time"])
-        writer.writeheader()
-        for model, stats in chat_aggregates.items():
-            count = stats["count"]
-            writer.writerow({
-                "session_model": model,
-                "number_of_chats": count,
-                "average_rounds": stats["rounds"] / count if count > 0 else 0,
-                "average_user_tokens": stats["user_tokens"] / count if count > 0 else 0,
-                "average_assistant_tokens": stats["assistant_tokens"] / count if count > 0 else 0,
-                "average_engagement_time": stats["engagement_time"] / count if count > 0 else 0
-            })
-        writer.writerow({
-            "session_model": "Overall",
-            "number_of_chats": overall_chat["count"],
-            "average_rounds": overall_chat["rounds"] / overall_chat["count"] if overall_chat["count"] > 0 else 0,
-            "average_user_tokens": overall_chat["user_tokens"] / overall_chat["count"] if overall_chat["count"] > 0 else 0,
-            "average_assistant_tokens": overall_chat["assistant_tokens"] / overall_chat["count"] if overall_chat["count"] > 0 else 0,
-            "average_engagement_time": overall_chat["engagement_time"] / overall_chat["count"] if overall_chat["count"] > 0 else 0
-        })
-    print("Chat statistics saved successfully.")
-
-    for interview_log in interview_logs:
-        interview_statistics = compute_interview_statistics(interview_log)
-        interview_stats.append(interview_statistics)
-        model = interview_statistics["session_model"]
-        for key in interview_statistics:
-            if key != "session_model":
-                interview_aggregates[model][key] += interview_statistics[key]
-                overall_interview[key] += interview_statistics[key]
-        interview_aggregates[model]["count"] += 1
-        overall_interview["count"] += 1
-
-    with open(f"{output_folder}/interview_model_aggregates.csv", "w", newline="", encoding="utf-8") as interview_aggregate_csv:
-        writer = csv.DictWriter(interview_aggregate_csv, fieldnames=["session_model", "number_of_interviews", "average_rounds", "average_user_tokens", "average_assistant_tokens", "average_engagement_time"])
-        writer.writeheader()
-        for model, stats in interview_aggregates.items():
-            count = stats["count"]
-            writer.writerow({
-                "session_model": model,
-                "number_of_interviews": count,
-                "average_rounds": stats["rounds"] / count if count > 0 else 0,
-                "average_user_tokens": stats["user_tokens"] / count if count > 0 else 0,
-                "average_assistant_tokens": stats["assistant_tokens"] / count if count > 0 else 0,
-                "average_engagement_time": stats["engagement_time"] / count if count > 0 else 0
-            })
-        writer.writerow({
-            "session_model": "Overall",
-            "number_of_interviews": overall_interview["count"],
-            "average_rounds": overall_interview["rounds"] / overall_interview["count"] if overall_interview["count"] > 0 else 0,
-            "average_user_tokens": overall_interview["user_tokens"] / overall_interview["count"] if overall_interview["count"] > 0 else 0,
-            "average_assistant_tokens": overall_interview["assistant_tokens"] / overall_interview["count"] if overall_interview["count"] > 0 else 0,
-            "average_engagement_time": overall_interview["engagement_time"] / overall_interview["count"] if overall_interview["count"] > 0 else 0
-        })
-    print("Interview statistics saved successfully.")
+    token_counter = token_counter or TokenCounter()
+    state = load_statistics_state(state_file)
+    for kind, logs_file in (("chat", chat_logs_file), ("interview", interview_logs_file)):
+        state[kind] = fold_records(logs_file, kind, state.get(kind), chunk_size, token_counter)
+    if token_counter.hits or token_counter.misses:
+        print(f"Token counts: {token_counter.hits} of {token_counter.hits + token_counter.misses} message texts served from the cache.")
+
+    if state_file:
+        save_statistics_state(state_file, state)
+    write_summaries(output_folder, state)
 
 if __name__ == "__main__":
     output_folder = "data"
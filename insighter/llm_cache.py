@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+class LLMCache:
+    """
+    Persistent, content-addressed cache of LLM responses stored in SQLite.
+    Entries are keyed by a hash of the model, the prompt messages and the sampling parameters,
+    and can expire after a TTL or be evicted (least recently used first) above a maximum size.
+    """
+    def __init__(self, path: str, ttl_seconds: float = None, max_entries: int = None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.writes_since_eviction = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model: str, messages: list, params: dict = None) -> str:
+        """
+        Build a stable key from everything that determines the response.
+        """
+        payload = json.dumps({"model": model, "messages": messages, "params": params or {}}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """
+        Returns the cached response for a key, or None on a miss or an expired entry.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, response):
+        """
+        Store a JSON-serializable response under a key.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(response), now, now),
+            )
+            self.conn.commit()
+            self.writes_since_eviction += 1
+            due = self.max_entries is not None and self.writes_since_eviction >= max(1, self.max_entries // 10)
+        if due:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop expired entries, then the least recently used entries above max_entries.
+        """
+        with self.lock:
+            if self.ttl_seconds is not None:
+                self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl_seconds,))
+            if self.max_entries is not None:
+                self.conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self.conn.commit()
+            self.writes_since_eviction = 0
+
+    def stats(self) -> dict:
+        """
+        Hit/miss counters for this process and the number of stored entries.
+        """
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self):
+        """
+        Apply eviction and close the database.
+        """
+        self.evict()
+        with self.lock:
+            self.conn.close()
+
+# Cache shared by every insighter stage; None disables caching.
+_cache = None
+
+def set_cache(cache: LLMCache):
+    """
+    Install the cache used by llm_client.chat_completion for all stages.
+    """
+    global _cache
+    _cache = cache
+
+def get_cache():
+    """
+    Returns the shared cache, or None if caching is disabled.
+    """
+    return _cache
@@ -0,0 +1,286 @@
+import os
+import time
+import random
+import threading
+from types import SimpleNamespace
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import openai
+
+from llm_cache import LLMCache, get_cache
+
+# Endpoints the insighter talks to: name -> (API key variable, base URL variable).
+ENDPOINTS = {
+    "bedrock": ("BEDROCK_API_KEY", "BEDROCK_BASE_URL"),
+    "openai": ("OPENAI_API_KEY", None),
+}
+
+# Retry policy for transient failures (rate limits, timeouts, connection errors, 5xx responses).
+MAX_ATTEMPTS = 8
+MIN_BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 60
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token estimate (about four characters per token) used for rate budgeting.
+    """
+    return max(1, len(text) // 4)
+
+class RateLimiter:
+    """
+    Thread-safe token-bucket limiter enforcing a requests-per-minute and a tokens-per-minute budget.
+    Either budget can be None to leave it unlimited.
+    """
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute or 0
+        self.available_tokens = tokens_per_minute or 0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Add the budget accrued since the last refill, capped at one minute's worth.
+        """
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.requests_per_minute:
+            self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens: int = 0):
+        """
+        Block until one request and the given number of tokens fit in the budget, then consume them.
+        """
+        if self.tokens_per_minute:
+            # A single request larger than the whole budget would otherwise wait forever.
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self.refill()
+                wait = 0
+                if self.requests_per_minute and self.available_requests < 1:
+                    wait = max(wait, (1 - self.available_requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self.available_tokens < tokens:
+                    wait = max(wait, (tokens - self.available_tokens) * 60 / self.tokens_per_minute)
+                if wait == 0:
+                    if self.requests_per_minute:
+                        self.available_requests -= 1
+                    if self.tokens_per_minute:
+                        self.available_tokens -= tokens
+                    return
+            time.sleep(wait)
+
+def ordered_map(fn, items, max_workers: int = 1, window: int = None):
+    """
+    Apply fn to each item using a thread pool and yield the results in input order.
+    At most `window` items are in flight at once, so items can be a lazy generator.
+    With max_workers <= 1 the items are processed sequentially in the calling thread.
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    window = window or max_workers * 4
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class EndpointRegistry:
+    """
+    Holds one pooled client and one rate limiter per endpoint, shared by every stage and thread.
+    """
+    def __init__(self):
+        self.clients = {}
+        self.limiters = {}
+        self.client_endpoints = {}
+        self.retryless_clients = {}
+        self.lock = threading.Lock()
+
+    def client(self, endpoint: str, max_connections: int = 64):
+        with self.lock:
+            if endpoint not in self.clients:
+                api_key_var, base_url_var = ENDPOINTS[endpoint]
+                # One keep-alive connection pool per endpoint, reused by all requests.
+                http_client = httpx.Client(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+                client = openai.OpenAI(
+                    api_key=os.getenv(api_key_var),
+                    base_url=os.getenv(base_url_var) if base_url_var else None,
+                    http_client=http_client,
+                )
+                self.clients[endpoint] = client
+                self.client_endpoints[id(client)] = endpoint
+            return self.clients[endpoint]
+
+    def limiter(self, endpoint: str):
+        with self.lock:
+            if endpoint not in self.limiters:
+                self.limiters[endpoint] = RateLimiter()
+            return self.limiters[endpoint]
+
+    def endpoint_of(self, client):
+        return self.client_endpoints.get(id(client))
+
+    def retryless(self, client):
+        """
+        Returns a copy of the client (sharing its connection pool) with the SDK's own retries disabled,
+        since chat_completion_choices retries itself.
+        """
+        with self.lock:
+            if id(client) not in self.retryless_clients:
+                self.retryless_clients[id(client)] = client.with_options(max_retries=0)
+            return self.retryless_clients[id(client)]
+
+registry = EndpointRegistry()
+
+def get_client(endpoint: str = "bedrock"):
+    """
+    Returns the shared, connection-pooled client for an endpoint ("bedrock" or "openai").
+    Environment variables (see .env.example) must be loaded before the first call.
+    """
+    return registry.client(endpoint)
+
+def configure_endpoint(endpoint: str, requests_per_minute: float = None, tokens_per_minute: float = None):
+    """
+    Sets the provider quota for an endpoint. Every call through chat_completion to that endpoint's client
+    shares this budget unless the caller passes its own rate limiter.
+    """
+    with registry.lock:
+        registry.limiters[endpoint] = RateLimiter(requests_per_minute, tokens_per_minute)
+
+class CallMetrics:
+    """
+    Thread-safe per-(endpoint, model) counters of calls, retries, errors, latency and token usage.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = defaultdict(lambda: {"calls": 0, "retries": 0, "errors": 0, "latency": 0.0, "prompt_tokens": 0, "completion_tokens": 0})
+
+    def record(self, endpoint: str, model: str, latency: float = 0.0, usage=None, retried: bool = False, failed: bool = False):
+        with self.lock:
+            stats = self.stats[(endpoint, model)]
+            if retried:
+                stats["retries"] += 1
+            elif failed:
+                stats["errors"] += 1
+            else:
+                stats["calls"] += 1
+                stats["latency"] += latency
+                if usage is not None:
+                    stats["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+                    stats["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+    def summary(self):
+        with self.lock:
+            return {key: dict(stats) for key, stats in self.stats.items()}
+
+    def print_summary(self):
+        for (endpoint, model), stats in sorted(self.summary().items()):
+            average_latency = stats["latency"] / stats["calls"] if stats["calls"] else 0
+            print(
+                f"{endpoint} / {model}: {stats['calls']} calls, {stats['retries']} retries, {stats['errors']} errors, "
+                f"{average_latency:.2f}s average latency, {stats['prompt_tokens']} prompt tokens, {stats['completion_tokens']} completion tokens"
+            )
+
+metrics = CallMetrics()
+
+def retry_delay(error, attempt: int) -> float:
+    """
+    Seconds to wait before retrying: the server's Retry-After header if it sent one,
+    otherwise exponential backoff with jitter.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after_ms = response.headers.get("retry-after-ms")
+        retry_after = response.headers.get("retry-after")
+        try:
+            if retry_after_ms is not None:
+                return float(retry_after_ms) / 1000
+            if retry_after is not None:
+                return float(retry_after)
+        except ValueError:
+            pass
+    backoff = min(MAX_BACKOFF_SECONDS, MIN_BACKOFF_SECONDS * 2 ** attempt)
+    return backoff * (0.5 + random.random() / 2)
+
+def chat_completion_choices(client, model: str, messages: list, rate_limiter: RateLimiter = None, use_cache: bool = True, sample_index: int = None, **params) -> list:
+    """
+    Calls client.chat.completions.create and returns the content of every choice.
+    Responses are served from the shared cache when possible. Repeated samples of the same
+    prompt (e.g. rating trials) pass a distinct sample_index so each one is cached separately;
+    use_cache=False opts a call out of the cache entirely.
+    Requests wait for the endpoint's shared rate limiter (or the one passed in), and transient
+    failures are retried up to MAX_ATTEMPTS times, honouring Retry-After.
+    """
+    cache = get_cache() if use_cache else None
+    if cache is not None:
+        key_params = dict(params, sample_index=sample_index) if sample_index is not None else params
+        key = LLMCache.make_key(model, messages, key_params)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    endpoint = registry.endpoint_of(client) or "custom"
+    if rate_limiter is None and endpoint != "custom":
+        rate_limiter = registry.limiter(endpoint)
+    if endpoint != "custom":
+        client = registry.retryless(client)
+    prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+
+    for attempt in range(MAX_ATTEMPTS):
+        if rate_limiter is not None:
+            rate_limiter.acquire(prompt_tokens)
+        start = time.monotonic()
+        try:
+            response = client.chat.completions.create(model=model, messages=messages, **params)
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                metrics.record(endpoint, model, failed=True)
+                raise
+            metrics.record(endpoint, model, retried=True)
+            time.sleep(retry_delay(e, attempt))
+            continue
+        except Exception:
+            metrics.record(endpoint, model, failed=True)
+            raise
+        metrics.record(endpoint, model, time.monotonic() - start, getattr(response, "usage", None))
+        break
+
+    contents = [(choice.message.content or "").strip() for choice in response.choices]
+
+    # Empty answers (e.g. cut off by the content filter) are not cached, so a retry asks the model again.
+    if cache is not None and all(contents):
+        cache.set(key, contents)
+    return contents
+
+class RoutedClient:
+    """
+    Stand-in for an OpenAI client, for third-party code that calls client.chat.completions.create itself
+    (e.g. BERTopic's OpenAI representation model). Requests go through chat_completion_choices, so they share
+    the endpoint's rate limiter, retries, metrics and cache like every other LLM call.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model: str, messages: list, **params):
+        contents = chat_completion_choices(self.client, model, messages, **params)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content)) for content in contents])
+
+def chat_completion(client, model: str, messages: list, rate_limiter: RateLimiter = None, use_cache: bool = True, sample_index: int = None, **params) -> str:
+    """
+    Same as chat_completion_choices, returning the content of the first choice only.
+    """
+    return chat_completion_choices(client, model, messages, rate_limiter, use_cache, sample_index, **params)[0]
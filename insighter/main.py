@@ -1,16 +1,19 @@
-from openai import OpenAI
 from dotenv import load_dotenv
 import os
+import sys
 
-from get_data import fetch_conversations_from_folder
-from data_cleanup import process_logs
+from get_data import fetch_conversations_from_folder, write_conversation_shards, removed_sources, save_manifest
+from data_cleanup import process_logs, parquet_path
 from interaction_statistics import process_statistics
+from token_counter import TokenCounter
 from insight_analysis import process_classifications_and_ratings
 from ratings_per_record import process_ratings_by_record
 from topic_analysis_chats import process_chat_topic_analysis
 from topic_analysis_interviews import process_interview_topic_analysis
 from topic_plots import create_topic_plots
 from correlation_plots import create_correlation_plots
+from llm_cache import LLMCache, set_cache
+from llm_client import configure_endpoint, get_client, metrics
 
 if __name__ == "__main__":
     load_dotenv("../.env")
@@ -31,28 +34,98 @@ if __name__ == "__main__":
     interview_logs_path = f"{output_folder}/interview_logs.json"
     csv_output_path = f"{output_folder}/conversation_quality.csv"
 
-    api_key = os.getenv("BEDROCK_API_KEY")
-    base_url = os.getenv("BEDROCK_BASE_URL")
-
     model = "us.anthropic.claude-3-5-sonnet-20241022-v2:0"
 
-    client = OpenAI(api_key=api_key, base_url=base_url)
+    # Stream logs into sharded JSONL files instead of a single JSON array (recommended for large corpora).
+    sharded_ingestion = False
+    compress_shards = False
+
+    # Only ingest logs that are new or changed since the last run (tracked in manifest.json),
+    # and merge the filtered delta into the existing chat and interview logs.
+    incremental = False
+    manifest_file = f"{output_folder}/manifest.json" if incremental else None
+    # Persist mergeable statistics state so that only newly appended log records are folded in.
+    statistics_state_file = f"{output_folder}/statistics_state.json" if incremental else None
+    # Count tokens in the statistics as whitespace-separated words ("words") or with a BPE tokenizer ("tiktoken").
+    # tiktoken downloads the encoding unless token_vocabulary_file points to a local copy of its .tiktoken file.
+    token_backend = "words"
+    token_encoding = "cl100k_base"
+    token_vocabulary_file = None
+
+    # Concurrency and provider quota for the LLM stages (None means unlimited).
+    # The quota is shared by every stage and thread calling the endpoint.
+    max_workers = 8
+    requests_per_minute = None
+    tokens_per_minute = None
+
+    # Judge up to this many short records per request (1, the default, judges each record on its own).
+    judge_batch_size = 1
+    judge_batch_token_budget = 4000
+    # Truncate long assistant turns so that each judged passage stays near this many tokens (None, the default, keeps them whole).
+    judge_passage_token_budget = None
+
+    # Classify one request per question ("pair", the default) or all questions of an interview in one request ("interview").
+    classification_mode = "pair"
+
+    # Get the rating trials of a row from one request per trial ("independent", the default), from one request ("multi_sample"),
+    # or run trials one by one and stop once min_rating_trials agree or the row cannot reach a valid average ("adaptive").
+    trial_mode = "independent"
+    min_rating_trials = 3
+
+    # Classify and rate the interviews of up to this many chatbot models at the same time.
+    model_workers = 6
+
+    # Also write columnar Parquet copies of the quality table and the chat/interview logs.
+    write_parquet = False
+
+    configure_endpoint("bedrock", requests_per_minute, tokens_per_minute)
+    client = get_client("bedrock")
+
+    # Cache LLM responses on disk so that reruns do not pay for the same prompts again.
+    llm_cache = LLMCache(f"{output_folder}/llm_cache.sqlite", ttl_seconds=None, max_entries=None)
+    set_cache(llm_cache)
 
     # 1. Compile conversations into one file
     print("CLUE-Insighter Step 1: Compile conversations into one file")
-    fetch_conversations_from_folder(input_folder, output_file)
+    if sharded_ingestion:
+        input_file_path = f"{output_folder}/conversations"
+        _, pending_manifest = write_conversation_shards(input_folder, input_file_path, compress=compress_shards, manifest_file=manifest_file)
+    else:
+        pending_manifest = fetch_conversations_from_folder(input_folder, output_file, manifest_file=manifest_file)
+    # Records of log files deleted since the last run are dropped from the outputs.
+    deleted_sources = removed_sources(manifest_file, pending_manifest) if pending_manifest is not None else set()
 
     # 2. Filter logs
     print("CLUE-Insighter Step 2: Filter logs")
-    process_logs(client, model, input_file_path, chat_logs_path, interview_logs_path, csv_output_path)
+    logs_processed = process_logs(client, model, input_file_path, chat_logs_path, interview_logs_path, csv_output_path, append=incremental,
+                                  max_workers=max_workers, write_parquet=write_parquet, batch_size=judge_batch_size, batch_token_budget=judge_batch_token_budget,
+                                  passage_token_budget=judge_passage_token_budget, removed_sources=deleted_sources)
+    # Only mark the ingested logs as seen once their records have been judged and written.
+    if pending_manifest is not None:
+        if logs_processed:
+            save_manifest(manifest_file, pending_manifest)
+        else:
+            print("Filtering logs failed; the manifest is left unchanged so the same logs are ingested again on the next run.")
 
     # 3. Statistics about chat and interview sessions
     print("CLUE-Insighter Step 3: Statistics about chat and interview sessions")
-    process_statistics(output_folder, chat_logs_path, interview_logs_path)
+    # Statistics are streamed from the logs; the Parquet copies are faster to read when they exist.
+    token_counter = TokenCounter(token_backend, token_encoding, token_vocabulary_file)
+    if write_parquet:
+        process_statistics(output_folder, parquet_path(chat_logs_path), parquet_path(interview_logs_path), statistics_state_file, token_counter=token_counter)
+    else:
+        process_statistics(output_folder, chat_logs_path, interview_logs_path, statistics_state_file, token_counter=token_counter)
 
     # 4. Get dimension classifications and ratings
     print("CLUE-Insighter Step 4: Get dimension classifications and ratings")
-    process_classifications_and_ratings(output_folder, client, interview_logs_path, model)
+    failed_models = process_classifications_and_ratings(output_folder, client, interview_logs_path, model, classification_mode,
+                                                        max_workers=max_workers, trial_mode=trial_mode, min_trials=min_rating_trials, model_workers=model_workers)
+    # The later steps read the classification and rating files of every model, so they would mix in stale or missing results.
+    if failed_models:
+        print(f"CLUE-Insighter: Stopping after step 4; rerun once {', '.join(failed_models)} can be classified and rated.")
+        llm_cache.close()
+        metrics.print_summary()
+        sys.exit(1)
 
     # 5. Get ratings per session
     print("CLUE-Insighter Step 5: Get ratings per session")
@@ -74,5 +147,12 @@ if __name__ == "__main__":
     print("CLUE-Insighter Step 9: Plot rating correlations")
     create_correlation_plots(output_folder, plot_folder)
 
+    cache_stats = llm_cache.stats()
+    print(f"LLM cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries")
+    llm_cache.close()
+
+    print("LLM calls:")
+    metrics.print_summary()
+
     print("CLUE-Insighter: Complete!")
 
@@ -1,49 +1,138 @@
 #!/usr/bin/env python3
+import json
+import threading
 import numpy as np
-from tenacity import retry, stop_after_attempt, wait_exponential, RetryError
+import openai
 from dotenv import load_dotenv
 
 from dimensions import DIMENSIONS
+from llm_client import RateLimiter, chat_completion, chat_completion_choices, registry
 
 # Load environment variables from .env file.
 load_dotenv("../.env")
 
 
-@retry(stop=stop_after_attempt(10), wait=wait_exponential(multiplier=1, min=1, max=16))
-def make_api_call(client, rating_prompt: str):
+RATING_MODEL = "us.anthropic.claude-3-5-sonnet-20241022-v2:0"
+RATING_SYSTEM_PROMPT = "You are a UX researcher. You are an expert at summarizing insights and themes from user experience interviews."
+
+# Whether each (endpoint, model) honours the n= parameter; missing until the first multi-sample request tells us.
+n_supported = {}
+n_supported_lock = threading.Lock()
+
+def make_api_call(client, rating_prompt: str, trial: int = None, rate_limiter: RateLimiter = None) -> str:
     """
-    Calls the LLM API using client.chat.completions.create.
-    This function is decorated with tenacity to automatically retry on exceptions.
+    Calls the LLM API and returns the response text.
+    Transient failures are retried with backoff by llm_client.chat_completion.
+    Each trial is cached separately, so repeated trials remain independent samples.
     """
-    return client.chat.completions.create(
-        model="us.anthropic.claude-3-5-sonnet-20241022-v2:0",
-        messages=[
-            {"role": "system", "content": "You are a UX researcher. You are an expert at summarizing insights and themes from user experience interviews."},
-            {"role": "user", "content": rating_prompt},
-        ],
-    )
+    return chat_completion(client, RATING_MODEL, [
+        {"role": "system", "content": RATING_SYSTEM_PROMPT},
+        {"role": "user", "content": rating_prompt},
+    ], rate_limiter, sample_index=trial)
 
-def get_rating(client, class_name: str, question: str, answer: str, confident_about: str = "the rating criteria") -> str:
+def build_rating_prompt(class_name: str, question: str, answer: str, confident_about: str = "the rating criteria", num_samples: int = 1) -> str:
     """
-    Constructs the prompt and calls the LLM API to get a rating.
-    Uses the make_api_call helper function which retries with exponential backoff.
+    Constructs the rating prompt. With num_samples > 1, asks for that many independent ratings as a JSON list.
     """
-    action = "provide a rating on a scale of 1-3."
-    rating_prompt = (
+    if num_samples == 1:
+        action = "provide a rating on a scale of 1-3."
+        instructions = f"Only provide the numeric rating without any explanation. If you are not confident about {confident_about}, respond 'NaN'."
+    else:
+        action = f"provide {num_samples} independent ratings on a scale of 1-3, as if {num_samples} different researchers rated it separately."
+        instructions = (
+            f"Only provide a JSON list of {num_samples} values without any explanation, e.g. [2, 3, 2]. "
+            f"For each rating, if you are not confident about {confident_about}, use \"NaN\" instead."
+        )
+    return (
         f"Based on the following user response about {DIMENSIONS.get(class_name, 'this aspect')}, "
-        f"{action} Only provide the numeric rating without any explanation. If you are not confident about {confident_about}, respond 'NaN'.\n\n"
+        f"{action} {instructions}\n\n"
         f"Question: {question}\n"
         f"Answer: {answer}"
     )
+
+def get_rating(client, class_name: str, question: str, answer: str, confident_about: str = "the rating criteria", trial: int = None, rate_limiter: RateLimiter = None) -> str:
+    """
+    Constructs the prompt and calls the LLM API to get a rating.
+    Uses the make_api_call helper function, which retries transient failures with backoff.
+    """
+    rating_prompt = build_rating_prompt(class_name, question, answer, confident_about)
     
     try:
-        response = make_api_call(client, rating_prompt)
-        rating_text = response.choices[0].message.content.strip()
-        return rating_text
-    except RetryError:
-        print("Maximum retry attempts reached for this API call. Returning 'NaN'.")
+        return make_api_call(client, rating_prompt, trial, rate_limiter)
+    except openai.APIError as e:
+        print(f"API call failed after retries: {e}. Returning 'NaN'.")
         return "NaN"
 
+def rejects_n(error) -> bool:
+    """
+    Whether a request error says the n= parameter is not supported (as opposed to e.g. a content filter).
+    Only the parameter the provider names in the error body is trusted, not the message text.
+    """
+    return getattr(error, "param", None) == "n"
+
+def parse_rating_list(response_content: str, num_samples: int):
+    """
+    Parses a JSON list of ratings. Returns None if it is malformed or has the wrong length.
+    """
+    start, end = response_content.find("["), response_content.rfind("]")
+    if start == -1 or end < start:
+        return None
+    try:
+        ratings = json.loads(response_content[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(ratings, list) or len(ratings) != num_samples:
+        return None
+    return [str(rating) for rating in ratings]
+
+def get_ratings(client, class_name: str, question: str, answer: str, num_samples: int, confident_about: str = "the rating criteria", rate_limiter: RateLimiter = None) -> list:
+    """
+    Gets num_samples independent ratings from as few requests as possible.
+    Uses one request with n=num_samples where the backend supports multiple completions, otherwise one
+    structured request asking for a list of ratings, and finally one request per trial if that cannot be parsed.
+    Whether n= is supported is remembered per endpoint and model.
+    """
+    if num_samples == 1:
+        return [get_rating(client, class_name, question, answer, confident_about, 0, rate_limiter)]
+
+    messages = [
+        {"role": "system", "content": RATING_SYSTEM_PROMPT},
+        {"role": "user", "content": build_rating_prompt(class_name, question, answer, confident_about)},
+    ]
+    backend = (registry.endpoint_of(client) or id(client), RATING_MODEL)
+    with n_supported_lock:
+        supported = n_supported.get(backend)
+    if supported is not False:
+        try:
+            ratings = chat_completion_choices(client, RATING_MODEL, messages, rate_limiter, n=num_samples)
+            supported = len(ratings) == num_samples
+            if supported:
+                with n_supported_lock:
+                    n_supported[backend] = True
+                return ratings
+        except openai.BadRequestError as e:
+            if rejects_n(e):
+                supported = False
+            else:
+                print(f"Multi-sample rating request failed: {e}. Requesting a list of ratings instead.")
+        except openai.APIError as e:
+            # Failures that survived the retries only affect this row; the next row tries n= again.
+            print(f"Multi-sample rating request failed after retries: {e}. Requesting a list of ratings instead.")
+        if supported is False:
+            with n_supported_lock:
+                n_supported[backend] = False
+            print("The rating backend does not support multiple completions; requesting a list of ratings instead.")
+
+    messages[1]["content"] = build_rating_prompt(class_name, question, answer, confident_about, num_samples)
+    try:
+        ratings = parse_rating_list(chat_completion(client, RATING_MODEL, messages, rate_limiter), num_samples)
+    except Exception as e:
+        print(f"Failed to get a list of ratings: {e}")
+        ratings = None
+    if ratings is None:
+        ratings = [get_rating(client, class_name, question, answer, confident_about, trial, rate_limiter) for trial in range(num_samples)]
+    return ratings
+
 def parse_rating(rating_text: str) -> float:
     """
     Converts the API's returned rating into a float.
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
-import csv
-import json
-from tqdm import tqdm
+import numpy as np
+import pandas as pd
+
+from get_data import iter_records
 
 # Expected classification types
 CLASS_TYPES = ["RQ1", "RQ2", "RQ3", "RQ4", "RQ6"]
 
+# Combined table of all models; deliberately not matching the *ratings_by_record_recreated.csv pattern
+# that correlation_plots reads, so models are not counted twice.
+COMBINED_OUTPUT = "all_models_ratings_by_record.csv"
+
 def count_qapairs(messages):
     """
     Count the number of Q/A pairs in a list of messages.
@@ -17,144 +22,162 @@ def count_qapairs(messages):
             count += 1
     return count
 
-def get_average(rating_list):
+def read_csv_as_text(filename):
     """
-    Given a list of rating strings, convert valid ones to float and return the average rounded to two decimals.
-    If no valid ratings are found, return "N/A".
+    Read a CSV file with every column as a string and empty fields kept as "".
     """
-    numeric_ratings = []
-    for r in rating_list:
-        try:
-            numeric_ratings.append(float(r))
-        except Exception:
-            continue
-    if numeric_ratings:
-        return round(sum(numeric_ratings) / len(numeric_ratings), 2)
-    return "N/A" if len(rating_list) > 0 else ""
+    return pd.read_csv(filename, dtype=str, keep_default_na=False)
 
-def process_model(input_folder, model, records):
+def load_model_pairs(input_folder, model, uids, pair_counts):
     """
-    Process records for a given model:
-      1. Count Q/A pairs per record using the interview logs.
-      2. Load the per-model classifications CSV (one row per Q/A pair).
-      3. Load the per-model ratings CSV files for each classification.
-      4. Reconstruct the record-level ratings using deterministic ordering.
-      5. Write out a CSV file named {model}_ratings_by_record.csv.
+    Load a model's classifications and per-class ratings and return one row per rated Q/A pair,
+    with columns record (position of the record within the model's records), classification and rating.
+    uids and pair_counts hold the uid and the number of Q/A pairs of each of the model's records.
+    Pairs are matched to records and ratings on (uid, pair_index); outputs written without those keys
+    are matched by position instead (Q/A pair counts of the records, then the n-th rating of each class).
+    Pairs whose rating is missing get an empty rating. Returns None if the classifications cannot be read.
     """
-    # === Step 1. Determine record boundaries for this model ===
-    # For each record, we count how many Q/A pairs (i.e. classifications) it produced.
-    record_boundaries = []  # List of tuples: (uid, num_pairs)
-    for record in records:
-        uid = record.get("uid", "nan")
-        messages = record.get("interview", [])
-        num_pairs = count_qapairs(messages)
-        record_boundaries.append((uid, num_pairs))
-
-    # === Step 2. Load the per-model classifications CSV ===
+    # === Load the per-model classifications CSV ===
     classifications_csv = f"{input_folder}/{model}_classifications.csv"
-    classifications = []
     try:
-        with open(classifications_csv, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                # Expected keys: "question", "answer", "classification"
-                classifications.append(row)
+        # Expected columns: "question", "answer", "classification" and, in keyed outputs, "uid" and "pair_index"
+        classifications = read_csv_as_text(classifications_csv)
     except Exception as e:
         print(f"Error reading {classifications_csv}: {e}")
-        return
+        return None
+    keyed = {"uid", "pair_index"}.issubset(classifications.columns)
 
-    # === Step 3. Load the per-model ratings CSV files for each classification type ===
-    ratings_by_type = {}
+    # === Load the per-model ratings CSV files for each classification type ===
+    rating_frames = []
     for cls in CLASS_TYPES:
-        # For example: model_RQ1.csv, model_RQ2.csv, ..., model_WILD.csv
+        # For example: model_RQ1.csv, model_RQ2.csv, ..., model_RQ6.csv
         filename = f"{input_folder}/{model}_ratings_{cls}.csv"
-        ratings_list = []
         try:
-            with open(filename, "r", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    # Expected key: "rating"
-                    ratings_list.append(row["rating"])
+            ratings = read_csv_as_text(filename)
         except FileNotFoundError:
             print(f"Warning: {filename} not found. No ratings for classification {cls} for model {model}.")
+            continue
         except Exception as e:
             print(f"Error reading {filename}: {e}")
-            return
-        ratings_by_type[cls] = ratings_list
-
-    # Pointer for each classification type to track our position in its ratings list.
-    pointers = {cls: 0 for cls in CLASS_TYPES}
-
-    # === Step 4. Reconstruct record-level ratings ===
-    results = []  # List to hold each record's average ratings.
-    overall_index = 0  # Pointer into the classifications list.
-    for uid, num_pairs in tqdm(record_boundaries, desc=f"Processing model {model}"):
-        # Create a temporary mapping: classification type -> list of ratings for this record.
-        record_ratings = {cls: [] for cls in CLASS_TYPES}
-        for i in range(num_pairs):
-            if overall_index + i >= len(classifications):
-                print(f"Warning: mismatch in expected classification count for model {model}.")
-                break
-            row = classifications[overall_index + i]
-            cls_type = row["classification"]
-            # Get the next available rating for this classification type.
-            if cls_type in ratings_by_type:
-                pointer = pointers[cls_type]
-                if pointer < len(ratings_by_type[cls_type]):
-                    rating_val = ratings_by_type[cls_type][pointer]
-                    pointers[cls_type] += 1
-                    record_ratings[cls_type].append(rating_val if rating_val.lower() != "nan" else "N/A")
-                else:
-                    record_ratings[cls_type].append("N/A")
-            else:
-                record_ratings.setdefault(cls_type, []).append("N/A")
-        overall_index += num_pairs
-
-        # Compute average ratings for each classification type.
-        avg_ratings = {}
-        for cls in CLASS_TYPES:
-            avg_ratings[cls] = get_average(record_ratings.get(cls, []))
-        avg_ratings["uid"] = uid
-        results.append(avg_ratings)
-
-    # === Step 5. Write out the per-model record-level ratings CSV ===
-    output_csv = f"{input_folder}/{model}_ratings_by_record_recreated.csv"
-    fieldnames = ["uid"] + CLASS_TYPES
-    try:
-        with open(output_csv, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            for rec in results:
-                writer.writerow(rec)
-        print(f"Processed model '{model}' and saved ratings by record to: {output_csv}")
-    except Exception as e:
-        print(f"Error writing output CSV {output_csv}: {e}")
+            return None
+        keyed = keyed and {"uid", "pair_index"}.issubset(ratings.columns)
+        ratings["classification"] = cls
+        ratings["rank"] = np.arange(len(ratings))
+        rating_frames.append(ratings)
+    ratings = pd.concat(rating_frames, ignore_index=True) if rating_frames else pd.DataFrame(columns=["uid", "pair_index", "classification", "rank", "rating"])
+
+    # === Attach each classified pair to its record ===
+    if keyed:
+        uids = pd.DataFrame({"uid": [str(uid) for uid in uids], "record": np.arange(len(uids))})
+        pairs = classifications.merge(uids, on="uid")
+        join_keys = ["uid", "pair_index", "classification"]
+    else:
+        print(f"Outputs for model {model} have no uid/pair_index keys; matching ratings to records by position.")
+        if sum(pair_counts) != len(classifications):
+            print(f"Warning: mismatch in expected classification count for model {model}.")
+        record_of_pair = np.repeat(np.arange(len(pair_counts)), pair_counts)[:len(classifications)]
+        pairs = classifications.iloc[:len(record_of_pair)].copy()
+        pairs["record"] = record_of_pair
+        # The n-th pair of a class takes the n-th row of that class's ratings file.
+        pairs["rank"] = pairs.groupby("classification").cumcount()
+        join_keys = ["classification", "rank"]
+
+    # Pairs of other classes (RQ5, WILD) are not rated.
+    pairs = pairs[pairs["classification"].isin(CLASS_TYPES)]
+    pairs = pairs[["record"] + join_keys].merge(ratings[join_keys + ["rating"]].drop_duplicates(join_keys), on=join_keys, how="left")
+    return pairs[["record", "classification", "rating"]].fillna({"rating": ""})
+
+def parse_ratings(ratings):
+    """
+    Convert rating strings to floats (NaN for missing or non-numeric ratings), parsing each distinct string once.
+    A literal "nan" rating means the rater was not confident; it never counts as a number.
+    """
+    codes, uniques = pd.factorize(ratings)
+    uniques = pd.Series(uniques, dtype=str)
+    values = pd.to_numeric(uniques, errors="coerce").to_numpy(dtype=float, copy=True)
+    values[(uniques.str.lower() == "nan").to_numpy()] = np.nan
+    return values[codes]
+
+def aggregate_ratings(pairs, num_records):
+    """
+    Average the numeric ratings of every (record, classification) group, rounded to two decimals.
+    pairs has columns row (the record's row in the output), classification and rating.
+    Returns a table with num_records rows and one column per classification type, holding the average,
+    "N/A" if the record has pairs of that type but none with a valid rating, or "" if it has none.
+    """
+    numeric = parse_ratings(pairs["rating"])
+    valid = ~np.isnan(numeric)
+    keys = pairs["row"].to_numpy() * len(CLASS_TYPES) + pd.Categorical(pairs["classification"], categories=CLASS_TYPES).codes
+    size = num_records * len(CLASS_TYPES)
+    pair_counts = np.bincount(keys, minlength=size)
+    valid_counts = np.bincount(keys, weights=valid, minlength=size)
+    sums = np.bincount(keys, weights=np.where(valid, numeric, 0), minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.round(sums / valid_counts, 2)
+    averages = np.where(valid_counts > 0, means.astype(object), np.where(pair_counts > 0, "N/A", ""))
+    return pd.DataFrame(averages.reshape(num_records, len(CLASS_TYPES)), columns=CLASS_TYPES)
 
 def process_ratings_by_record(input_folder, interview_logs_file):
     """
-    Process the ratings by record for each model.
+    Process the ratings by record for all models in one pass.
+    Writes {model}_ratings_by_record_recreated.csv for each model and all_models_ratings_by_record.csv with every model.
+    A record without pairs of a classification gets an empty value; a record whose pairs have no valid rating gets "N/A".
+    The interview logs are streamed; only the uid and Q/A pair count of each record are kept.
     """
+    # === Group records by model ===
+    # Here, we use the "session_model" field from each record.
+    models = {}
     try:
-        with open(interview_logs_file, "r", encoding="utf-8") as f:
-            interview_logs = json.load(f)
+        for record in iter_records(interview_logs_file):
+            model = record.get("session_model", "unknown").replace("/", "_")
+            if model not in models:
+                models[model] = ([], [])
+            models[model][0].append(record.get("uid", "nan"))
+            models[model][1].append(count_qapairs(record.get("interview", [])))
     except Exception as e:
         print(f"Error reading {interview_logs_file}: {e}")
         return
 
-    # === Group records by model ===
-    # Here, we use the "session_model" field from each record.
-    models = {}
-    for record in interview_logs:
-        model = record.get("session_model", "unknown").replace("/", "_")
-        if model not in models:
-            models[model] = []
-        models[model].append(record)
-
-    # Process each model's records separately.
-    for model, records in models.items():
+    # === Collect the rated pairs of every model into one table ===
+    # Records of all models get consecutive output rows; each model's pairs are offset to its records' rows.
+    record_frames = []
+    pair_frames = []
+    num_records = 0
+    for model, (uids, pair_counts) in models.items():
         print(f"Processing records for model: {model}")
-        process_model(input_folder, model, records)
-    
+        pairs = load_model_pairs(input_folder, model, uids, pair_counts)
+        if pairs is None:
+            continue
+        pair_frames.append(pd.DataFrame({
+            "row": pairs["record"].to_numpy() + num_records,
+            "classification": pairs["classification"],
+            "rating": pairs["rating"],
+        }))
+        record_frames.append(pd.DataFrame({"model": model, "uid": uids}))
+        num_records += len(uids)
+    if not record_frames:
+        return
+
+    # === Average the ratings per record and classification type ===
+    averages = aggregate_ratings(pd.concat(pair_frames, ignore_index=True), num_records)
+    results = pd.concat([pd.concat(record_frames, ignore_index=True), averages], axis=1)
+
+    # === Write out the per-model and combined record-level ratings CSVs ===
+    for model, model_results in results.groupby("model", sort=False):
+        output_csv = f"{input_folder}/{model}_ratings_by_record_recreated.csv"
+        try:
+            model_results[["uid"] + CLASS_TYPES].to_csv(output_csv, index=False)
+            print(f"Processed model '{model}' and saved ratings by record to: {output_csv}")
+        except Exception as e:
+            print(f"Error writing output CSV {output_csv}: {e}")
+
+    output_csv = f"{input_folder}/{COMBINED_OUTPUT}"
+    try:
+        results[["model", "uid"] + CLASS_TYPES].to_csv(output_csv, index=False)
+        print(f"Saved ratings by record of all models to: {output_csv}")
+    except Exception as e:
+        print(f"Error writing output CSV {output_csv}: {e}")
+
 if __name__ == "__main__":
     # Path to the original interview logs JSON file.
     input_folder = "data"
@@ -0,0 +1,278 @@
+import math
+import numpy as np
+import pandas as pd
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative accuracy (DDSketch-style logarithmic buckets).
+    A value x > 0 is counted in bucket ceil(log_gamma(x)), so any quantile is returned within
+    relative_accuracy of the true value. Negative values use a mirrored set of buckets, and values
+    closer to zero than MIN_VALUE are counted as zero. Whole numbers below EXACT_LIMIT (typical
+    round and token counts) are counted exactly instead. Sketches with the same accuracy merge exactly.
+    """
+    MIN_VALUE = 1e-9
+    EXACT_LIMIT = 4096
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.exact = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add_many(self, values):
+        """
+        Add an array of values.
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        zero = np.abs(values) < self.MIN_VALUE
+        self.zero_count += int(zero.sum())
+        exact = ~zero & (values > 0) & (values < self.EXACT_LIMIT) & (values == np.floor(values))
+        keys, counts = np.unique(values[exact].astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.exact[key] = self.exact.get(key, 0) + count
+        for store, selected in ((self.positive, values[~zero & ~exact & (values > 0)]), (self.negative, -values[~zero & (values < 0)])):
+            keys, counts = np.unique(np.ceil(np.log(selected) / self.log_gamma).astype(np.int64), return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                store[key] = store.get(key, 0) + count
+        self.count += len(values)
+
+    def merge(self, other):
+        """
+        Add the counts of another sketch with the same relative accuracy.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge quantile sketches with different relative accuracies.")
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative), (self.exact, other.exact)):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def bucket_value(self, key: int) -> float:
+        """
+        The value representing a bucket: within relative_accuracy of everything counted in it.
+        """
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q: float) -> float:
+        """
+        Approximate q-quantile (0 <= q <= 1) of the added values, or NaN if the sketch is empty.
+        Interpolates linearly between the two values around rank q * (count - 1), like np.quantile.
+        """
+        if self.count == 0:
+            return float("nan")
+        rank = q * (self.count - 1)
+        lower_rank = math.floor(rank)
+        items = [(-self.bucket_value(key), count) for key, count in self.negative.items()]
+        items += [(0.0, self.zero_count)] + [(float(value), count) for value, count in self.exact.items()]
+        items += [(self.bucket_value(key), count) for key, count in self.positive.items()]
+        items.sort()
+        lower = upper = items[-1][0]
+        seen = 0
+        for value, count in items:
+            if not count:
+                continue
+            if seen <= lower_rank < seen + count:
+                lower = value
+            if seen <= lower_rank + 1 < seen + count:
+                upper = value
+                break
+            seen += count
+        return lower + (upper - lower) * (rank - lower_rank)
+
+    def histogram(self, edges) -> list:
+        """
+        Approximate number of values in each bin [edges[i], edges[i + 1]). Values outside the edges are not counted.
+        """
+        counts = [0] * (len(edges) - 1)
+        items = [(-self.bucket_value(key), count) for key, count in self.negative.items()]
+        items += [(0.0, self.zero_count)] + [(float(value), count) for value, count in self.exact.items()]
+        items += [(self.bucket_value(key), count) for key, count in self.positive.items()]
+        for value, count in items:
+            index = int(np.searchsorted(edges, value, side="right")) - 1
+            if 0 <= index < len(counts):
+                counts[index] += count
+        return counts
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": {str(key): count for key, count in self.positive.items()},
+            "negative": {str(key): count for key, count in self.negative.items()},
+            "exact": {str(key): count for key, count in self.exact.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        sketch = cls(data["relative_accuracy"])
+        sketch.positive = {int(key): count for key, count in data["positive"].items()}
+        sketch.negative = {int(key): count for key, count in data["negative"].items()}
+        sketch.exact = {int(key): count for key, count in data["exact"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        return sketch
+
+class FieldSummary:
+    """
+    Mergeable summary of one statistic: count, sum, sum of squares, min, max and a quantile sketch.
+    Counts and means are exact under merging; quantiles are approximate (see QuantileSketch).
+    """
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add_many(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.sum_sq += float(np.square(values).sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.sketch.add_many(values)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    def mean(self) -> float:
+        """
+        Mean, or NaN for an empty summary so it is written as a blank cell rather than a real 0.
+        """
+        return self.sum / self.count if self.count else float("nan")
+
+    def std(self) -> float:
+        """
+        Population standard deviation, or NaN for an empty summary.
+        """
+        if not self.count:
+            return float("nan")
+        return math.sqrt(max(0.0, self.sum_sq / self.count - self.mean() ** 2))
+
+    def quantile(self, q: float) -> float:
+        """
+        Approximate quantile, clamped to the exact min and max, or NaN for an empty summary.
+        """
+        if not self.count:
+            return float("nan")
+        return min(self.max, max(self.min, self.sketch.quantile(q)))
+
+    def to_dict(self) -> dict:
+        # An empty summary stores null rather than the non-standard JSON Infinity.
+        return {
+            "count": self.count, "sum": self.sum, "sum_sq": self.sum_sq,
+            "min": self.min if self.count else None, "max": self.max if self.count else None,
+            "sketch": self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        summary = cls()
+        summary.count = data["count"]
+        summary.sum = data["sum"]
+        summary.sum_sq = data["sum_sq"]
+        summary.min = data["min"] if data["min"] is not None else float("inf")
+        summary.max = data["max"] if data["max"] is not None else float("-inf")
+        summary.sketch = QuantileSketch.from_dict(data["sketch"])
+        return summary
+
+class SummaryState:
+    """
+    Mergeable summaries of per-record statistics, grouped by one or more key columns (by default per model).
+    Each group holds a FieldSummary per field and a plain total per counter column.
+    update() folds a batch of per-record statistics in time proportional to the batch, and merge() combines
+    states built from different batches or shards. The state round-trips through JSON via to_dict/from_dict.
+    """
+    def __init__(self, fields: list, counters: list = (), keys: list = ("session_model",), relative_accuracy: float = 0.01):
+        self.fields = list(fields)
+        self.counters = list(counters)
+        self.keys = list(keys)
+        self.relative_accuracy = relative_accuracy
+        self.groups = {}
+
+    def empty_group(self) -> dict:
+        return {
+            "fields": {field: FieldSummary(self.relative_accuracy) for field in self.fields},
+            "counters": {counter: 0 for counter in self.counters},
+        }
+
+    def group(self, key: tuple) -> dict:
+        if key not in self.groups:
+            self.groups[key] = self.empty_group()
+        return self.groups[key]
+
+    def update(self, stats: pd.DataFrame):
+        """
+        Fold per-record statistics (the key columns plus one column per field and counter) into the state.
+        """
+        for key, rows in stats.groupby(self.keys, sort=False, dropna=False):
+            group = self.group(tuple(key))
+            for field in self.fields:
+                group["fields"][field].add_many(rows[field].to_numpy())
+            for counter in self.counters:
+                group["counters"][counter] += int(rows[counter].sum())
+
+    def merge_group(self, group: dict, other: dict):
+        for field in self.fields:
+            group["fields"][field].merge(other["fields"][field])
+        for counter in self.counters:
+            group["counters"][counter] += other["counters"][counter]
+
+    def merge(self, other):
+        """
+        Add the summaries of another state over the same fields, counters and keys.
+        """
+        for key, other_group in other.groups.items():
+            self.merge_group(self.group(key), other_group)
+
+    def overall(self) -> dict:
+        """
+        The summaries of all groups combined.
+        """
+        overall = self.empty_group()
+        for group in self.groups.values():
+            self.merge_group(overall, group)
+        return overall
+
+    def to_dict(self) -> dict:
+        return {
+            "fields": self.fields,
+            "counters": self.counters,
+            "keys": self.keys,
+            "relative_accuracy": self.relative_accuracy,
+            "groups": [
+                {
+                    "key": list(key),
+                    "fields": {field: summary.to_dict() for field, summary in group["fields"].items()},
+                    "counters": group["counters"],
+                }
+                for key, group in self.groups.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        state = cls(data["fields"], data["counters"], data["keys"], data["relative_accuracy"])
+        for group in data["groups"]:
+            state.groups[tuple(group["key"])] = {
+                "fields": {field: FieldSummary.from_dict(summary) for field, summary in group["fields"].items()},
+                "counters": group["counters"],
+            }
+        return state
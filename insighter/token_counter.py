@@ -0,0 +1,121 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# Token counting backends: "words" counts whitespace-separated words (no extra dependency),
+# "tiktoken" counts BPE tokens with a tiktoken encoding or a local BPE vocabulary file.
+BACKENDS = ["words", "tiktoken"]
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# Download location and sha256 of the .tiktoken vocabulary of each encoding that can be loaded from a local copy.
+# tiktoken caches a download under the sha1 of its URL, so a verified copy placed there is used instead of downloading.
+# gpt2 is built from two data_gym files instead of one .tiktoken file and can't be loaded this way.
+BLOB_URL = "https://openaipublic.blob.core.windows.net/encodings"
+LOCAL_VOCABULARIES = {
+    "r50k_base": (f"{BLOB_URL}/r50k_base.tiktoken", "306cd27f03c1a714eca7108e03d66b7dc042abe8c258b44c199a7ed9838dd930"),
+    "p50k_base": (f"{BLOB_URL}/p50k_base.tiktoken", "94b5ca7dff4d00767bc256fdd1b27e5b17361d7b8a5f968547f9f23eb70d2069"),
+    "p50k_edit": (f"{BLOB_URL}/p50k_base.tiktoken", "94b5ca7dff4d00767bc256fdd1b27e5b17361d7b8a5f968547f9f23eb70d2069"),
+    "cl100k_base": (f"{BLOB_URL}/cl100k_base.tiktoken", "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7"),
+    "o200k_base": (f"{BLOB_URL}/o200k_base.tiktoken", "446a9538cb6c348e3516120d7c08b09f57c36495e2acfffe59a5bf8b0cfb1a2d"),
+}
+
+def tiktoken_cache_dir() -> str:
+    """
+    The folder tiktoken reads cached vocabularies from, resolved the way tiktoken resolves it.
+    """
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        return os.environ["TIKTOKEN_CACHE_DIR"]
+    if "DATA_GYM_CACHE_DIR" in os.environ:
+        return os.environ["DATA_GYM_CACHE_DIR"]
+    return os.path.join(tempfile.gettempdir(), "data-gym-cache")
+
+def count_words(texts) -> np.ndarray:
+    """
+    Number of whitespace-separated words of each text.
+    """
+    return np.array([len(text.split()) for text in texts], dtype=np.int64)
+
+class TokenCounter:
+    """
+    Counts the tokens of many texts at once with a pluggable backend.
+    The BPE backend encodes all uncached texts of a call in one batch, and caches each count under a hash
+    of its text, so messages repeated across records (greetings, interview questions) are only encoded once.
+    tiktoken is only imported when the BPE backend is used. A vocabulary_file holding a copy of the
+    encoding's .tiktoken file is loaded locally instead of downloading it; it must match the encoding.
+    """
+    def __init__(self, backend: str = "words", encoding_name: str = DEFAULT_ENCODING, vocabulary_file: str = None, max_cache_entries: int = 1000000):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown token counting backend {backend!r}; expected one of {BACKENDS}.")
+        self.backend = backend
+        self.encoding_name = encoding_name
+        self.vocabulary_file = vocabulary_file
+        self.max_cache_entries = max_cache_entries
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.encoding = self.load_encoding() if backend == "tiktoken" else None
+
+    def load_encoding(self):
+        import tiktoken
+        if self.vocabulary_file:
+            self.install_vocabulary()
+        return tiktoken.get_encoding(self.encoding_name)
+
+    def install_vocabulary(self):
+        """
+        Places the local vocabulary file in tiktoken's cache, after checking it is the encoding's vocabulary.
+        """
+        if self.encoding_name not in LOCAL_VOCABULARIES:
+            raise ValueError(f"The tiktoken encoding {self.encoding_name!r} can't be loaded from a local vocabulary file; "
+                             f"expected one of {list(LOCAL_VOCABULARIES)}.")
+        url, expected_hash = LOCAL_VOCABULARIES[self.encoding_name]
+        with open(self.vocabulary_file, "rb") as f:
+            if hashlib.sha256(f.read()).hexdigest() != expected_hash:
+                raise ValueError(f"{self.vocabulary_file} is not the {self.encoding_name} vocabulary.")
+
+        cache_dir = tiktoken_cache_dir()
+        if not cache_dir:
+            raise ValueError("TIKTOKEN_CACHE_DIR is set to an empty string, which turns off the cache a local vocabulary file is loaded from.")
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest())
+        # Copy to a temporary name first so a concurrent run never reads a partial file.
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        shutil.copyfile(self.vocabulary_file, tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    @property
+    def name(self) -> str:
+        """
+        Identifies what the counts mean; statistics counted with different tokenizers must not be mixed.
+        """
+        if self.backend == "words":
+            return "words"
+        return f"tiktoken:{self.encoding_name}"
+
+    def count_many(self, texts: list) -> np.ndarray:
+        """
+        Number of tokens of each text.
+        """
+        if self.encoding is None:
+            return count_words(texts)
+
+        keys = [hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest() for text in texts]
+        counts = np.array([self.cache.get(key, -1) for key in keys], dtype=np.int64)
+        missing = np.flatnonzero(counts < 0)
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if len(missing):
+            # Encode each distinct uncached text once.
+            unique = {}
+            for index in missing.tolist():
+                unique.setdefault(keys[index], texts[index])
+            encoded = self.encoding.encode_batch(list(unique.values()), disallowed_special=())
+            if len(self.cache) + len(unique) > self.max_cache_entries:
+                self.cache.clear()
+            for key, tokens in zip(unique, encoded):
+                self.cache[key] = len(tokens)
+            counts[missing] = [self.cache[keys[index]] for index in missing.tolist()]
+        return counts
@@ -1,18 +1,19 @@
 from umap import UMAP
 from hdbscan import HDBSCAN
-import openai
 from sklearn.feature_extraction.text import CountVectorizer
 from bertopic import BERTopic
 from bertopic.representation import OpenAI
 from bertopic.backend import OpenAIBackend
 
-import json
 import numpy as np
 import pandas as pd
 import argparse
 import os
 from dotenv import load_dotenv
 
+from get_data import iter_records
+from llm_client import RoutedClient, get_client
+
 def extract_qa_from_chat_logs(chat_logs_file):
     """
     Extract Q&A pairs from chat logs where the assistant asks questions and the user responds.
@@ -25,10 +26,7 @@ def extract_qa_from_chat_logs(chat_logs_file):
     doc_to_session = {}
     session_counter = {}
     
-    with open(chat_logs_file, 'r') as file:
-        chat_logs = json.load(file)
-    
-    for chat_log in chat_logs:
+    for chat_log in iter_records(chat_logs_file):
         model_name = chat_log.get("session_model", "unknown")
         messages = chat_log.get("session", [])
         
@@ -66,15 +64,16 @@ def process_chat_topic_analysis(chat_logs_file: str, output_folder: str):
     aggregated_session_counts = {}  # Per model: { model: { session_id: {"non_minus1": set(), "minus1_count": int} } }
     
     # Initialize embedding and representation models.
-    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    client = get_client("openai")
     embedding_model = OpenAIBackend(client, "text-embedding-3-small", delay_in_seconds=1, batch_size=1024)
     
     umap_model = UMAP(n_neighbors=15, n_components=5, min_dist=0.0, metric='cosine', random_state=42)
     hdbscan_model = HDBSCAN(min_cluster_size=15, metric='euclidean', cluster_selection_method='eom', prediction_data=True)
     vectorizer_model = CountVectorizer(stop_words="english", min_df=2, ngram_range=(1, 2))
     
-    client = openai.OpenAI(api_key=os.getenv("BEDROCK_API_KEY"), base_url=os.getenv("BEDROCK_BASE_URL"))
-    representation_model = OpenAI(client, "us.anthropic.claude-3-5-sonnet-20241022-v2:0", exponential_backoff=True, chat=True)
+    client = get_client("bedrock")
+    # Topic labels are requested through the shared endpoint client, which rate-limits and retries them.
+    representation_model = OpenAI(RoutedClient(client), "us.anthropic.claude-3-5-sonnet-20241022-v2:0", chat=True)
     
     # --- Process Each Model Individually ---
     for model_name, qa_pairs in qa_by_model.items():
@@ -188,7 +187,7 @@ def process_chat_topic_analysis(chat_logs_file: str, output_folder: str):
     pd.DataFrame(session_details_list).to_csv(f"{output_folder}/session_topic_details.csv", index=False)
     
     for k, m in topic_models.items():
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = get_client("openai")
         embedding_model_save = OpenAIBackend(client, "text-embedding-3-small", delay_in_seconds=1, batch_size=128)
         save_path = os.path.join(f"{output_folder}/chat-models", k)
         m.save(save_path, serialization="safetensors", save_ctfidf=True, save_embedding_model=embedding_model_save)
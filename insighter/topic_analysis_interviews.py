@@ -10,13 +10,14 @@ from umap import UMAP
 from hdbscan import HDBSCAN
 from sklearn.feature_extraction.text import CountVectorizer
 
-import openai
 from bertopic import BERTopic
 from bertopic.backend import OpenAIBackend
 from bertopic.representation import OpenAI
 
 from dotenv import load_dotenv
 
+from llm_client import RoutedClient, chat_completion, get_client
+
 # Define common variants of "yes" and "no"
 yes_variants = [
     "yes", "yeah", "yep", "yup", "sure", "of course", "certainly", "absolutely",
@@ -93,15 +94,12 @@ Provide the insights as a **Python list** (e.g., ["Insight 1", "Insight 2"]). Ke
 Answer: "{response_text}"
 Insights:"""
     try:
-        response = client.chat.completions.create(
-            model="us.anthropic.claude-3-5-sonnet-20241022-v2:0",
-            messages=[
-                {"role": "system", "content": "You are an AI assistant that extracts key insights from user feedback."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        response_content = chat_completion(client, "us.anthropic.claude-3-5-sonnet-20241022-v2:0", [
+            {"role": "system", "content": "You are an AI assistant that extracts key insights from user feedback."},
+            {"role": "user", "content": prompt}
+        ])
         # Use eval to convert the returned text to a Python list
-        insights = eval(response.choices[0].message.content.strip())
+        insights = eval(response_content)
         return insights if isinstance(insights, list) else []
     except Exception as e:
         # On error, simply return an empty list.
@@ -155,9 +153,9 @@ def process_interview_topic_analysis(csv_directory: str = None):
         return
 
     # Use a dedicated client for insight extraction.
-    insight_client = openai.OpenAI(api_key=os.getenv("BEDROCK_API_KEY"), base_url=os.getenv("BEDROCK_BASE_URL"))
+    insight_client = get_client("bedrock")
     
-    print("Extracting insights from each answer (including duplicates)...", flush=True)
+    print("Extracting insights from each distinct answer...", flush=True)
     
     # Dictionaries to hold the document lists.
     # documents_by_classification: aggregated across all models.
@@ -187,27 +185,39 @@ def process_interview_topic_analysis(csv_directory: str = None):
         # List to store each answer and its extracted insights.
         all_answer_insights = []
         
-        # Process each Q&A pair, extracting insights per instance.
-        for model in qa_by_model:
-            for classification in tqdm(qa_by_model[model]):
-                for _, answer in tqdm(qa_by_model[model][classification]):
-                    # Normalize the answer (clean and lowercase) for consistency.
-                    normalized_answer = clean_answer(answer).lower()
-                    insights = extract_insights(insight_client, normalized_answer)
-                    
-                    # Save the answer and its insights.
-                    all_answer_insights.append({
-                        "model": model,
-                        "classification": classification,
-                        "answer": answer,
-                        "insights": insights
-                    })
-                    
-                    # For each insight, add it (possibly truncated) to our document lists.
-                    for insight in insights:
-                        doc = insight[:8000]
-                        documents_by_classification[classification].append(doc)
-                        documents_by_model[model][classification].append(doc)
+        # Normalize every answer (clean and lowercase) for consistency.
+        occurrences = [
+            (model, classification, answer, clean_answer(answer).lower())
+            for model in qa_by_model
+            for classification in qa_by_model[model]
+            for _, answer in qa_by_model[model][classification]
+        ]
+
+        # Extract insights once per distinct normalized answer; repeated answers reuse them.
+        distinct_answers = list(dict.fromkeys(normalized_answer for _, _, _, normalized_answer in occurrences))
+        print(f"{len(distinct_answers)} distinct answers out of {len(occurrences)}.")
+        insights_by_answer = {
+            normalized_answer: extract_insights(insight_client, normalized_answer)
+            for normalized_answer in tqdm(distinct_answers)
+        }
+
+        # Fan the insights back out to every occurrence.
+        for model, classification, answer, normalized_answer in occurrences:
+            insights = insights_by_answer[normalized_answer]
+
+            # Save the answer and its insights.
+            all_answer_insights.append({
+                "model": model,
+                "classification": classification,
+                "answer": answer,
+                "insights": insights
+            })
+
+            # For each insight, add it (possibly truncated) to our document lists.
+            for insight in insights:
+                doc = insight[:8000]
+                documents_by_classification[classification].append(doc)
+                documents_by_model[model][classification].append(doc)
         
         # Save all answers and insights to a JSON file for inspection.
         with open(f"{csv_directory}/answers_insights.json", "w", encoding="utf-8") as f:
@@ -233,14 +243,14 @@ def process_interview_topic_analysis(csv_directory: str = None):
             return None
 
         # Use a client for embedding/topic modeling.
-        topic_client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        topic_client = get_client("openai")
         embedding_model = OpenAIBackend(topic_client, "text-embedding-3-small", delay_in_seconds=1, batch_size=128)
         umap_model = UMAP(n_neighbors=5, n_components=5, min_dist=0.0, metric='cosine', random_state=42)
         hdbscan_model = HDBSCAN(min_cluster_size=5, metric='euclidean', cluster_selection_method='eom', prediction_data=True)
         vectorizer_model = CountVectorizer(stop_words="english", min_df=2, ngram_range=(1, 2))
-        rep_client = openai.OpenAI(api_key=os.getenv("BEDROCK_API_KEY"), base_url=os.getenv("BEDROCK_BASE_URL"))
-        representation_model = OpenAI(rep_client, "us.anthropic.claude-3-5-sonnet-20241022-v2:0",
-                                    exponential_backoff=True, chat=True)
+        rep_client = get_client("bedrock")
+        # Topic labels are requested through the shared endpoint client, which rate-limits and retries them.
+        representation_model = OpenAI(RoutedClient(rep_client), "us.anthropic.claude-3-5-sonnet-20241022-v2:0", chat=True)
 
         topic_model = BERTopic(
             embedding_model=embedding_model,